@@ -1,20 +1,13 @@
 ﻿# BestJarvisAI_Bot.py - бот для работы с личными финансами и финконсультаций
 # === standard library ===
 import asyncio
-import io
-import json
 import logging
 import os
-import re
+from contextlib import aclosing
 from datetime import datetime
 from io import BytesIO
 
 # === third-party ===
-import gspread
-import matplotlib.pyplot as plt
-import pandas as pd
-from duckduckgo_search import DDGS
-from oauth2client.service_account import ServiceAccountCredentials
 from telegram import (
     InputFile,
     Update,
@@ -22,7 +15,7 @@ from telegram import (
     InlineKeyboardMarkup,
     InlineKeyboardButton
 )
-from telegram.error import TimedOut
+from telegram.error import BadRequest, RetryAfter, TimedOut
 from telegram.ext import (
     ApplicationBuilder,
     CallbackQueryHandler,
@@ -33,18 +26,36 @@ from telegram.ext import (
 )
 
 # === my internal modules ===
+import ai_client
+import charts
 import config
+import history_store
+import metrics
+import page_fetcher
+import search_store
+from search_client import web_search, search_stage, format_sources
+from intent_router import rates_table, route_intent
+from classifier import extract_financial_items
+from exporter import EXPORT_FORMATS, ExportError, build_export
+import ledger
 from ai_client import (     # подключаем работу с AI
-     chat_completion as _chat_completion,
-     text_completion as _text_completion
+     async_text_completion as _text_completion,
+     async_text_completion_stream as _text_completion_stream
 )
+from conversation import ConversationContext
+from session_store import SessionStore, PendingStore, Sweeper
+from inbox import Inboxes
+from telegram_sender import sender, split_text
 from config import (
     CATEGORY_EXPENSE, CATEGORY_INCOME, CATEGORY_INVESTMENT, CATEGORY_OTHER,
-    ALLOWED_CATEGORIES, CURRENCY_MAP, MAX_SEARCH_DEPTH
+    ALLOWED_CATEGORIES, CURRENCY_MAP, MAX_SEARCH_DEPTH, SEARCH_MAX_QUERIES, ADMIN_IDS,
+    SUMMARY_THRESHOLD_TURNS, SUMMARY_KEEP_TURNS, SEARCH_FOLLOWUP_TURNS,
+    STREAM_EDIT_INTERVAL_SEC, TELEGRAM_MAX_MESSAGE_LEN
 )
 
 from google_sheet_client import (
-    get_or_create_sheet_for_user,
+    get_spreadsheet,
+    sheet_writer,
     write_valid_data,
     log_error
 )
@@ -75,10 +86,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                   " Напиши мне что-нибудь.")
 
 
-# Хранилище истории
-user_histories = {}
-pending: dict[int, list[list[str]]] = {}
 MAX_HISTORY = 1000
+SUMMARY_MONTHS = 6  # сколько последних месяцев показывать в /summary
 
 
 DEFAULT_ROLE_PROMPT = (
@@ -109,13 +118,17 @@ DEFAULT_ROLE_PROMPT = (
     "У тебя есть возможность инициировать интернет-поиск. Если ты начнёшь ответ с `SEARCH:`, система выполнит поиск "
     "и пришлёт тебе результаты, после чего ты сможешь продолжить ответ."
     "Если для ответа не хватает актуальной информации (например, курсы валют, биржевые котировки, новости, экономические"
-    " события), начни ответ с `SEARCH:` и укажи текст запроса.\n\n"
+    " события), начни ответ с `SEARCH:` и укажи текст запроса.\n"
+    "Если нужно найти сразу несколько вещей, перечисли запросы в той же строке через « | » "
+    f"(не больше {SEARCH_MAX_QUERIES}) — они будут выполнены одновременно.\n\n"
 
     "**Примеры:**\n"
     "Пользователь: Какой сейчас курс доллара?\n"
     "Твой ответ: SEARCH: текущий курс доллара к рублю\n\n"
     "Пользователь: Что говорят о рынке нефти?\n"
     "Твой ответ: SEARCH: последние новости о рынке нефти\n\n"
+    "Пользователь: Сравни доходность ОФЗ и депозитов\n"
+    "Твой ответ: SEARCH: доходность ОФЗ сейчас | средние ставки по вкладам\n\n"
 
     "Никогда не говори, что ты не можешь ответить. Если не знаешь ответа — инициируй поиск, как указано выше.\n"
     "Даже если ты уверен в ответе, предпочитай использовать SEARCH: для курсов валют, биржевых данных, котировок, "
@@ -127,54 +140,104 @@ DEFAULT_ROLE_PROMPT = (
 
 
 
-def save_user_history(user_id):
-    # cохраняем историю конкретного пользователя в JSON-файл (с дописыванием)
-    try:
-        file_path = config.LOG_DIR / f"{user_id}.json"
-
-        # загружаем существующую историю, если файл присутствует
-        if file_path.exists():
-            with open(file_path, "r", encoding="utf-8") as f:
-                existing_data = json.load(f)
-        else:
-            existing_data = []
+def flush_context(user_id: int, ctx: ConversationContext):
+    # дописываем на диск только новые реплики пользователя (и свежее резюме, если есть);
+    # сама запись и fsync идут в фоновом потоке history_store
+    history_store.append_records(user_id, ctx.drain_unsaved(), MAX_HISTORY)
 
-        # добавляем новые данные
-        existing_data.extend(user_histories[user_id])
 
-        # ограничиваем количество записей
-        existing_data = existing_data[-MAX_HISTORY:]
+# Контексты активных пользователей (user_id -> ConversationContext); молчащие и лишние
+# выгружаются на диск. Найденные операции ждут подтверждения не дольше PENDING_TTL_SEC.
+user_histories = SessionStore(on_evict=flush_context)
+pending = PendingStore()
+_sweeper = Sweeper(user_histories, pending)
 
-        # ну и сохраняем в файл
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(existing_data, f, ensure_ascii=False, indent=2)
 
-        logger.info(f"История пользователя {user_id} сохранена в файл.")
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении истории {user_id}: {e}")
+def save_user_history(user_id, ctx: ConversationContext | None = None):
+    # ctx передаётся, если контекст могли выгрузить, пока шёл ответ модели:
+    # его новые реплики всё равно должны попасть на диск
+    ctx = ctx or user_histories.get(user_id)
+    if ctx is not None:
+        flush_context(user_id, ctx)
+        user_histories.touch(user_id)
 
 
-def load_user_history(user_id):
-    #загружает историю конкретного пользователя из JSON-файла
+async def load_user_history(user_id):
+    # загружает хвост истории конкретного пользователя, не блокируя event loop
     try:
-        file_path = config.LOG_DIR / f"{user_id}.json"
-        if file_path.exists():
-            with open(file_path, "r", encoding="utf-8") as f:
-                return json.load(f)
+        return await asyncio.wrap_future(history_store.load_records(user_id, MAX_HISTORY))
     except Exception as e:
         logger.error(f"Ошибка при загрузке истории пользователя {user_id}: {e}")
     return []  # Если не удалось загрузить историю, возвращаем пустой список
 
 
+async def get_context(user_id: int) -> ConversationContext:
+    # контекст пользователя из памяти; если его нет (новый пользователь или контекст
+    # выгружен) — загружаем историю с диска или создаём заново
+    ctx = user_histories.get(user_id)
+    if ctx is not None:
+        return ctx
+    history = await load_user_history(user_id)
+
+    # пока история читалась, контекст мог создать параллельный апдейт этого же пользователя
+    ctx = user_histories.get(user_id)
+    if ctx is None:
+        # роль (инструкция о работе) закреплена в самом контексте
+        ctx = ConversationContext(DEFAULT_ROLE_PROMPT, history, max_history=MAX_HISTORY)
+        # Если история не найдена — сообщаем модели текущее время
+        if not history:
+            now_str = datetime.now().strftime("%d.%m.%Y %H:%M")
+            ctx.append("user", f"Сейчас {now_str}.")
+        # Не показывая пользователю, сохраняем предустановленные
+        # данные в память текущего сеанса
+        user_histories.put(user_id, ctx)
+    return ctx
+
+
+SUMMARY_PROMPT = (
+    "Ты ведёшь конспект диалога пользователя с финансовым ассистентом JARVIS. "
+    "Сожми приведённые реплики в краткое резюме (не более 15 предложений). Сохрани факты о пользователе, "
+    "его доходах, расходах, целях, принятых решениях, данных рекомендациях и незакрытых вопросах. "
+    "Если есть предыдущее резюме — дополни его новыми сведениями, устаревшее убери. "
+    "Ответь только текстом резюме, без вступлений."
+)
+
+
+async def summarize_history(user_id: int, ctx: ConversationContext):
+    # сворачивает старые реплики пользователя в резюме; последние SUMMARY_KEEP_TURNS остаются дословно
+    folded = ctx.start_summary(SUMMARY_KEEP_TURNS)
+    if not folded:
+        return
+    try:
+        dialog = "\n".join(
+            f"{'JARVIS' if msg.role == 'model' else 'Пользователь'}: {' '.join(msg.parts)}"
+            for msg in folded
+        )
+        prompt = (
+            f"{SUMMARY_PROMPT}\n\n"
+            f"Предыдущее резюме: {ctx.summary or 'нет'}\n\n"
+            f"Новые реплики:\n{dialog}"
+        )
+        summary = (await _text_completion(prompt, user_id=user_id)).strip()
+
+        # пока модель думала, пользователь мог сбросить контекст — тогда резюме уже не нужно
+        if summary and user_histories.get(user_id) is ctx:
+            ctx.apply_summary(summary, folded)
+            save_user_history(user_id, ctx)
+            logger.info(f"История пользователя {user_id} свёрнута в резюме ({len(folded)} реплик).")
+    except Exception as e:
+        logger.error(f"Ошибка при сворачивании истории {user_id}: {e}")
+    finally:
+        ctx.finish_summary()
+
+
 async def reset_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     try:
-        if user_id in user_histories:
-            del user_histories[user_id]
-
-        file_path = config.LOG_DIR / f"{user_id}.json"
-        if file_path.exists():
-            file_path.unlink()
+        # сбрасываем между ходами, чтобы не выдернуть контекст из-под идущего ответа
+        async with inboxes.locked(user_id):
+            user_histories.discard(user_id)
+            history_store.delete_history(user_id)
 
         try:
             await reply_with_retry(update, "Контекст очищен. Начнём с чистого листа.")
@@ -190,40 +253,6 @@ async def reset_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             pass
 
-# далее классифицируем сообщение пользователя, чтобы
-# личные финансы внести в Google-таблицу через API
-def extract_financial_items(message: str) -> list[dict]:
-    try:
-        system_prompt = (
-            "Ты выступаешь в роли классификатора пользовательских сообщений по учёту личных финансов. "
-            "Твоя задача — извлечь **все** упомянутые пользователем **фактические** финансовые операции, "
-            "даже если сумма кажется небольшой или незначительной. "
-            "Не фильтруй и не оценивай, важна ли сумма — если пользователь сообщил о транзакции с числом и валютой, это важно.\n\n"
-            "Извлекай только то, что касается **реальных операций пользователя** (его доходы, расходы, инвестиции). "
-            "Игнорируй гипотетические, шутки, аналитику и вопросы.\n\n"
-            "Для каждого действия укажи:\n"
-            "- category: расход / доход / инвестиции\n"
-            "- amount: число без пробелов\n"
-            "- currency: символ или слово (₽, $, €, юань и т.п.)\n"
-            "- text: короткий фрагмент, откуда взяты данные\n\n"
-            "Формат ответа: JSON-массив словарей, каждый из которых имеет ключи: category, amount, currency, text\n"
-            "Если нет ни одной подходящей операции — верни [].\n\n"
-            f"Сообщение: {message}"
-        )
-
-        raw_text = _chat_completion(system_prompt, message)
-        logger.info(f"Ответ Gemini на классификацию: {raw_text}")
-
-        # Вырезаем только JSON между ```json ... ```
-        match = re.search(r"```(?:json)?\s*(\[.*?\])\s*```", raw_text, re.DOTALL)
-        json_text = match.group(1) if match else raw_text.strip()
-
-        parsed = json.loads(json_text)
-        return parsed if isinstance(parsed, list) else []
-    except Exception as e:
-        logger.error(f"Ошибка разбора JSON в extract_financial_items: {e}")
-        return []
-
 def is_valid_item(item: dict) -> bool:
     try:
         category = item.get("category", "").strip().lower()
@@ -246,48 +275,81 @@ def normalize_currency(val: str) -> str:
     return v.upper()
 
 #🔎
-# Обработчик входящих сообщений от пользователя
+# Обработчик входящих сообщений от пользователя: сообщение встаёт во входящую очередь
+# пользователя, серия быстрых сообщений обрабатывается одним ходом (см. inbox.py)
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await inboxes.submit(update.effective_user.id, (update, context))
+
+
+async def handle_turn(items: list[tuple[Update, ContextTypes.DEFAULT_TYPE]]):
+    # отвечаем на последнее сообщение серии, текст всех сообщений склеиваем по порядку
+    update, context = items[-1]
     try:
         # Получаем текст сообщения пользователя, ID этого пользователя и его ник (если есть)
-        user_input = update.message.text
+        user_input = "\n".join(u.message.text for u, _ in items if u.message and u.message.text)
         user_id = update.effective_user.id
-        username = update.effective_user.username or "без_ника"
 
         # Если у пользователя ещё нет истории в памяти — загружаем её с диска или создаём заново
-        if user_id not in user_histories:
-            history = load_user_history(user_id)
-
-            # Если история не найдена — добавляем приветствие с текущей датой и роль
-            if not history:
-                # формируем для Gemini текущую дату
-                now_str = datetime.now().strftime("%d.%m.%Y %H:%M")
-                history = [
-                    {"role": "user", "parts": [DEFAULT_ROLE_PROMPT]},   # добавляет роль (инструкцию о работе)
-                    {"role": "user", "parts": [f"Сейчас {now_str}."]}   # сообщает текущее время модели
-                ]
-            # Не показывая пользователю, сохраняем предустановленные
-            # данные в память текущего сеанса
-            user_histories[user_id] = history
+        ctx = await get_context(user_id)
 
         # Логируем полученное сообщение
         logger.info(f"Вход от @{update.effective_user.username}: {user_input}")
 
         # Добавляем поступившее сообщение пользователя в историю
-        user_histories[user_id].append({"role": "user", "parts": [user_input]})
-        user_histories[user_id] = user_histories[user_id][-MAX_HISTORY:]  # ограничиваем длину истории
+        # (контекст сам ограничивает длину истории и бюджет промпта)
+        ctx.append("user", user_input)
+
+        # Дата, время и курсы валют отвечаются сразу, без модели и поиска
+        # (если курсы устарели, route_intent вернёт None и вопрос уйдёт в модель)
+        quick = route_intent(user_input)
+        if quick:
+            ctx.append("model", quick)
+            save_user_history(user_id, ctx)
+            await reply_with_retry(update, quick)
+            return
 
-        # Получаем первый ответ от модели на основе текущей истории
-        #response = model.generate_content(user_histories[user_id])
-        #text = response.text.strip()  # убираем лишние пробелы/переводы строк
-        # Собираем историю в один строковый prompt
-        prompt = "\n".join(
-            part
-            for msg in user_histories[user_id]
-            for part in msg["parts"]
+        # Ответ модели и извлечение операций зависят только от сообщения пользователя,
+        # поэтому идут параллельно: клавиатура подтверждения появляется, как только
+        # закончилось извлечение, не дожидаясь ответа модели (и наоборот)
+        await asyncio.gather(
+            answer_user(update, context, ctx),
+            confirm_financial_items(update, user_input)
         )
 
-        text = _text_completion(prompt).strip()
+    # === Обработка любых ошибок ===
+    except asyncio.TimeoutError:
+        logger.warning(f"Таймаут модели при обработке сообщения пользователя {update.effective_user.id}")
+        await reply_with_retry(update, "⌛ Модель слишком долго отвечает, попробуйте ещё раз чуть позже.")
+    except Exception as e:
+        logger.exception("Ошибка при обработке сообщения")
+        await reply_with_retry(update, "⚠️ Произошла ошибка при обработке запроса.")
+
+
+# входящие очереди пользователей: ходы одного пользователя идут по порядку,
+# а разные пользователи обслуживаются параллельно (concurrent_updates)
+inboxes = Inboxes(handle_turn)
+
+
+# промпт для очередного хода. Если в последних репликах есть ссылка на поиск, результаты
+# которого ещё хранятся в search_store, они снова подставляются в промпт — для уточняющих
+# вопросов вроде «а что во втором источнике?». В историю результаты по-прежнему не пишутся
+def prompt_with_recent_search(ctx: ConversationContext) -> str:
+    recent = list(ctx.history)[-SEARCH_FOLLOWUP_TURNS:]
+    found = search_store.latest(part for msg in reversed(recent) for part in msg.parts)
+    if found is None:
+        return ctx.prompt()
+    ref, sources = found
+    return f"{ctx.prompt()}\nРезультаты недавнего поиска #{ref}, на который ссылается диалог: {format_sources(sources)}"
+
+
+# отвечает пользователю: модель + при необходимости циклы интернет-поиска
+async def answer_user(update: Update, context: ContextTypes.DEFAULT_TYPE, ctx: ConversationContext):
+    user_id = update.effective_user.id
+    live = LiveReply(update)
+    try:
+        # Получаем первый ответ от модели на основе текущей истории
+        # (пользователь видит его по мере генерации)
+        text = await stream_completion(live, prompt_with_recent_search(ctx), user_id)
 
         # У БЯМ есть возможность инициировать веб-поиск путём создания обратного
         # ответа с интернет-запросом. Такой ответ предваряется префиксом "SEARCH:"
@@ -296,40 +358,50 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # не превысим количество допустимых поисков за одну сессию.
 
         # Инициализируем счётчики поиска (до начала цикла)
-        new_text = await handle_search_cycles(update, context, text)
+        new_text = await handle_search_cycles(update, context, ctx, text, live)
         if new_text is None:
+            await live.discard()    # убираем статус поиска
             return  # ждем нажатия «Продолжить» или «Стоп»
         text = new_text
 
         # Если был превышен лимит поиска
         if "SEARCH:" in text:
-            user_histories[user_id].append({
-                "role": "user",
-                "parts": [
-                    "Дополнительные данные не найдены. Пожалуйста, продолжи ответ, используя доступную информацию."]
-            })
-
-
-            # Собираем историю в один строковый prompt
-            prompt = "\n".join(
-                part
-                for msg in user_histories[user_id]
-                for part in msg["parts"]
+            ctx.append(
+                "user",
+                "Дополнительные данные не найдены. Пожалуйста, продолжи ответ, используя доступную информацию."
             )
-            text = _text_completion(prompt).strip()
+            text = await stream_completion(live, ctx.prompt(), user_id)
 
 
         # Добавляем финальный ответ модели в историю (при этом нам не важно, какой это
         # был ответ - на сообщение самого пользователя или на сообщение после поиска)
-        user_histories[user_id].append({"role": "model", "parts": [text]})
-        user_histories[user_id] = user_histories[user_id][-MAX_HISTORY:]  # обрезаем историю, если она слишком длинная
-        save_user_history(user_id)  # сохраняем историю пользователя на диск
+        ctx.append("model", text)
+        save_user_history(user_id, ctx)  # сохраняем историю пользователя на диск
 
         # отправляем итоговый ответ пользователю в Telegram
-        await reply_with_retry(update, text)
+        # (дописываем его в уже показанное сообщение, если ответ шёл потоком)
+        await live.finish(text)
+
+        # если история разрослась — сворачиваем старые реплики в резюме в фоне,
+        # пользователь уже получил ответ и ждать этого не должен
+        if ctx.needs_summary(SUMMARY_THRESHOLD_TURNS):
+            context.application.create_task(summarize_history(user_id, ctx))
+
+    except asyncio.TimeoutError:
+        logger.warning(f"Таймаут модели при обработке сообщения пользователя {user_id}")
+        await reply_with_retry(update, "⌛ Модель слишком долго отвечает, попробуйте ещё раз чуть позже.")
+    except Exception as e:
+        logger.exception("Ошибка при обработке сообщения")
+        await reply_with_retry(update, "⚠️ Произошла ошибка при обработке запроса.")
 
+# извлекает из сообщения личные финансовые операции и просит подтвердить запись
+async def confirm_financial_items(update: Update, user_input: str):
+    user_id = update.effective_user.id
+    username = update.effective_user.username or "без_ника"
+    try:
         # дополнительно: пытаемся извлечь и сохранить личную финансовую операцию (если есть)
-        items = extract_financial_items(user_input) # сначала извлекаем операции из текста
+        # (простые записи разбираются локально, сообщения без сумм до модели не доходят)
+        items = await extract_financial_items(user_input, user_id) # сначала извлекаем операции из текста
         # убираем вероятные дубли по сочетанию category+amount+currency+text
         seen = set()
         unique_items = []
@@ -359,7 +431,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # если обнаружили валидные данные, то пишем их в таблицу, если пользователь подтвердит, конечно
         if valid_rows:
             # сохраняем найденное во временное хранилище
-            pending[user_id] = valid_rows
+            pending.put(user_id, valid_rows)
             # формируем текст подтверждения
             lines = []
             for row in valid_rows:
@@ -374,7 +446,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                  InlineKeyboardButton("❌ Нет", callback_data="confirm_no")]
             ])
 
-            await update.message.reply_text(
+            await reply_with_retry(
+                update,
                 f"Я распознал Вашу личную финансовую операцию:\n{summary}\n\nПодтвердите запись:",
                 reply_markup=keyboard
             )
@@ -383,19 +456,20 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # если хоть что-то модель распознала как "личные финансы", пусть ввод пользователя и некорректен...
         elif items:
             # операция есть, но невалидная — кладём в "ошибки" и просим пользователя уточнить
-            log_error(user_id, username, user_input, items)
+            await log_error(user_id, username, user_input, items)
             await reply_with_retry(update,
                                "⚠️ Я увидел финансовые данные, но не смог их корректно распознать. "
                                "Пожалуйста, укажи сумму и валюту (например: 1000 руб), чтобы я мог внести запись "
                                "в файл с вашими финансами.")
 
-    # === Обработка любых ошибок ===
     except Exception as e:
-        logger.exception("Ошибка при обработке сообщения")
-        await reply_with_retry(update, "⚠️ Произошла ошибка при обработке запроса.")
+        logger.exception("Ошибка при извлечении финансовых операций")
 
-async def handle_search_cycles(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> str:
+async def handle_search_cycles(update: Update, context: ContextTypes.DEFAULT_TYPE, ctx: ConversationContext,
+                               text: str, live: "LiveReply | None" = None) -> str:
     # обрабатывает префикс SEARCH: от модели внутри handle_message.
+    # Результаты поиска дописываются в контекст текущего хода (ctx), а не в заново
+    # полученный через get_context: тот мог быть выгружен и загружен повторно.
     # Возвращает обновлённый текст ответа без SEARCH: либо None,
     # если нужно ждать нажатия кнопки.
 
@@ -408,53 +482,69 @@ async def handle_search_cycles(update: Update, context: ContextTypes.DEFAULT_TYP
     # Инициализируем счётчики поиска (до начала цикла)
     user_data = context.user_data
     user_data.setdefault("search_count", 0)
-    user_data.setdefault("last_search_results", "")
 
     # найдём именно ту часть текста, где начинается запрос в Интернет
     _, after = text.split("SEARCH:", 1)
-    query = after.strip().splitlines()[0]
+    # модель может попросить несколько поисков сразу: «SEARCH: запрос 1 | запрос 2»
+    queries = [q.strip() for q in after.strip().splitlines()[0].split("|") if q.strip()]
+    query = " | ".join(queries)
 
     # Пока не превысили порог количества поисков – инициируем циклы поиска автоматически
     if user_data["search_count"] < MAX_SEARCH_DEPTH:
         stage = user_data["search_count"] + 1
-        waiting = await update.message.reply_text(f"🔍 Gemini ведёт поиск в Интернете, этап №{stage}")
-        results = perform_web_search(query)
-        await waiting.delete()
+        status = f"🔍 Gemini ведёт поиск в Интернете, этап №{stage}"
+        # статус показываем в том же сообщении, где потом появится ответ:
+        # каждый этап — одна правка вместо пары «отправить / удалить»
+        waiting = None
+        if live is not None:
+            await live.show(status, force=True)
+        else:
+            waiting = await reply_with_retry(update, status)
+        sources = await search_stage(queries)
+        if waiting is not None:
+            await sender.delete(waiting)
 
-        user_data["last_search_results"] = results
+        if sources is None:
+            ref, results = None, "⚠️ Ошибка при поиске в интернете."
+        else:
+            ref = search_store.put(queries, sources)
+            results = format_sources(sources)
         user_data["search_count"] += 1
 
         uid = update.effective_user.id
-        user_histories[uid].append({
-            "role": "user",
-            "parts": [f"Вот, что удалось найти по теме: «{query}»: {results}\n\n"
-                      f"Пожалуйста, проанализируй информацию и ответь кратко по сути. "
-                      "Если в тексте есть ссылки — обязательно упоминай их в ответе, не скрывай. "
-                      "Пользователь хочет видеть ссылки прямо в ответе."]
-        })
-
-        prompt = "\n".join(part for msg in user_histories[uid] for part in msg["parts"])
-        return _text_completion(prompt).strip().lstrip()
+        # в историю попадает только короткая ссылка на результаты; сам текст
+        # результатов идёт в промпт лишь на этом этапе и в следующие промпты не переносится
+        ctx.append("user", search_store.reference(ref, queries, sources) if ref else f"[Поиск: «{query}» не удался]")
+        prompt = (
+            f"{ctx.prompt()}\n"
+            f"Вот, что удалось найти по теме: «{query}»: {results}\n\n"
+            f"Пожалуйста, проанализируй информацию и ответь кратко по сути. "
+            "Если в тексте есть ссылки — обязательно упоминай их в ответе, не скрывай. "
+            "Пользователь хочет видеть ссылки прямо в ответе."
+        )
+        if live is not None:
+            return await stream_completion(live, prompt, uid)
+        return (await _text_completion(prompt, user_id=uid)).strip()
 
     # достигли предела итераций автопоиска – показываем кнопки и ждём callback
     kb_text, kb = generate_continue_stop_keyboard(user_data["search_count"])
-    await update.message.reply_text(kb_text, reply_markup=kb)
+    await reply_with_retry(update, kb_text, reply_markup=kb)
     return None
 
 
 async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = " ".join(context.args)
     if not query:
-        await update.message.reply_text("Укажите запрос: /search ваш запрос")
+        await reply_with_retry(update, "Укажите запрос: /search ваш запрос")
         return
 
     try:
         # Выполняем поиск без дальнейшей обработки
-        results = perform_web_search(query)
-        await update.message.reply_text(results)
+        results = await perform_web_search(query)
+        await reply_with_retry(update, results)
     except Exception as e:
         logger.error(f"Ошибка поиска: {e}")
-        await update.message.reply_text("⚠️ Не удалось выполнить поиск.")
+        await reply_with_retry(update, "⚠️ Не удалось выполнить поиск.")
 
 
 # === Глобальный перехват ошибок в Telegram Application ===
@@ -463,44 +553,97 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     if isinstance(update, Update) and update.message:
         await reply_with_retry(update,"⚠️ Произошла внутренняя ошибка. Мы уже в курсе.")
 
-async def reply_with_retry(update: Update, text: str, max_retries: int = 3, delay_sec: int = 2):
-    msg_waiting: Message | None = None
-
-    for attempt in range(1, max_retries + 2):  # попытки 1, 2, 3, 4
+async def reply_with_retry(update: Update, text: str, **kwargs) -> Message | None:
+    # ответ идёт через общий диспетчер telegram_sender: лимиты Telegram, повтор после
+    # RetryAfter / TimedOut, длинный текст — несколькими сообщениями
+    try:
+        return await sender.reply(update.message, text, **kwargs)
+    except Exception as e:
+        logger.error(f"Ошибка при отправке сообщения: {e}")
+        return None
+
+
+# Ответ модели, который пользователь видит по мере генерации: сообщение отправляется
+# с первыми словами, дальше обновляется через edit_text не чаще STREAM_EDIT_INTERVAL_SEC
+# (Telegram ограничивает частоту правок одного чата)
+class LiveReply:
+    def __init__(self, update: Update):
+        self.update = update
+        self.message: Message | None = None
+        self.text = ""              # что сейчас видит пользователь
+        self._next_edit = 0.0
+
+    async def show(self, text: str, force: bool = False) -> bool:
+        text = text.strip()[:TELEGRAM_MAX_MESSAGE_LEN]
+        if not text or text == self.text:
+            return True
+        now = asyncio.get_running_loop().time()
+        # промежуточные правки пропускаем, если лимит чата сейчас исчерпан
+        if not force and (now < self._next_edit or not sender.ready(self.update.effective_chat.id)):
+            return False
         try:
-            # Перед отправкой ответа — удаляем ожидание, если оно было
-            if msg_waiting:
-                try:
-                    await msg_waiting.delete()
-                except Exception as e:
-                    logger.warning(f"Не удалось удалить сообщение ожидания: {e}")
-                msg_waiting = None
-
-            return await update.message.reply_text(text)
-
+            if self.message is None:
+                self.message = await sender.run(self.update.effective_chat.id,
+                                                self.update.message.reply_text, text)
+            else:
+                await sender.edit(self.message, text)
+            self.text = text
+            self._next_edit = now + STREAM_EDIT_INTERVAL_SEC
+            return True
+        except RetryAfter as e:
+            self._next_edit = now + e.retry_after
+        except BadRequest as e:
+            logger.warning(f"Не удалось обновить потоковый ответ: {e}")
         except TimedOut:
-            if attempt == 1:
-                try:
-                    msg_waiting = await update.message.reply_text("⌛ Запрос обрабатывается, небольшая задержка…")
-                except:
-                    pass
-            await asyncio.sleep(delay_sec)
+            self._next_edit = now + STREAM_EDIT_INTERVAL_SEC
+        return False
 
+    async def discard(self) -> None:
+        # убираем показанный текст (например, статус поиска перед кнопками «Продолжить / Стоп»)
+        if self.message is not None:
+            await sender.delete(self.message)
+        self.message = None
+        self.text = ""
+
+    async def finish(self, text: str) -> None:
+        # окончательный текст: первой частью правим показанное сообщение, остальные части
+        # (если ответ не помещается в одно сообщение) отправляем следом
+        chunks = split_text(text)
+        if self.message is not None and chunks:
+            for _ in range(3):
+                if await self.show(chunks[0], force=True):
+                    chunks = chunks[1:]
+                    break
+                await asyncio.sleep(max(0.0, self._next_edit - asyncio.get_running_loop().time()))
+            else:
+                await self.discard()
+        try:
+            await sender.reply_chunks(self.update.message, chunks)
         except Exception as e:
             logger.error(f"Ошибка при отправке сообщения: {e}")
-            break
 
-    # если не удалось после всех попыток
-    if msg_waiting:
-        try:
-            await msg_waiting.edit_text("❌ Превышено время ожидания ответа от Telegram.")
-        except:
-            pass
-    else:
-        try:
-            await update.message.reply_text("❌ Превышено время ожидания ответа от Telegram.")
-        except:
-            pass
+
+async def stream_completion(live: LiveReply, prompt: str, user_id: int) -> str:
+    # получает ответ модели потоком и показывает его в live по мере генерации.
+    # Ответ с SEARCH: пользователю не показывается: как только строка запроса
+    # дописана, генерация прерывается и начинается поиск
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    text = ""
+    async with aclosing(_text_completion_stream(prompt, user_id=user_id)) as chunks:
+        async for chunk in chunks:
+            if not text:
+                metrics.set_gauge("llm.first_token_sec", round(loop.time() - started, 3))
+            text += chunk
+            if "SEARCH:" in text:
+                if "\n" in text.split("SEARCH:", 1)[1].strip():
+                    break
+                continue
+            head = text.lstrip()
+            if len(head) < len("SEARCH:") and "SEARCH:".startswith(head):
+                continue    # это может оказаться началом SEARCH:
+            await live.show(text)
+    return text.strip()
 
 
 # Генератор клавиатуры телеграмма для управления повторным поиском в интернете
@@ -517,102 +660,158 @@ def generate_continue_stop_keyboard(stage: int):
     return text, InlineKeyboardMarkup(keyboard)
 
 
+# /chart — круговая диаграмма доходов/расходов, /chart month — доходы и расходы по месяцам
 async def send_pie_chart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
-        username = update.effective_user.username or "без_ника"
-
-        worksheet = get_or_create_sheet_for_user(user_id)
-        records = worksheet.get_all_records()
 
-        totals = {config.CATEGORY_EXPENSE: 0, config.CATEGORY_INCOME: 0}
-
-        for row in records:
-            category = str(row.get("Категория", "")).strip().lower()
-            amount = str(row.get("Сумма", "") or "0").replace(',', '.').strip()
-            if category in totals and amount.replace('.', '', 1).isdigit():
-                totals[category] += float(amount)
-
-        if sum(totals.values()) == 0:
+        if context.args and context.args[0].lower() in ("month", "месяц", "monthly"):
+            # суммы по месяцам (валюты складываются, как и в круговой диаграмме)
+            monthly = await ledger.monthly_totals(user_id)
+            months = sorted({month for month, _, _ in monthly})[-SUMMARY_MONTHS:]
+            series = {config.CATEGORY_EXPENSE: [0.0] * len(months), config.CATEGORY_INCOME: [0.0] * len(months)}
+            for (month, category, _), total in monthly.items():
+                if category in series and month in months:
+                    series[category][months.index(month)] += total
+            kind, data = "monthly", {"title": "Доходы и расходы по месяцам", "months": months, "series": series}
+            empty = not months
+        else:
+            # суммы по категориям считает локальное зеркало операций (ledger), а не скачанный лист
+            by_category = await ledger.category_totals(user_id)
+            totals = {
+                config.CATEGORY_EXPENSE: by_category.get(config.CATEGORY_EXPENSE, 0),
+                config.CATEGORY_INCOME: by_category.get(config.CATEGORY_INCOME, 0)
+            }
+            kind, data = "pie", {"title": "Структура: Доходы и Расходы", "values": totals}
+            empty = sum(totals.values()) == 0
+
+        if empty:
             await reply_with_retry(update, "Нет данных для построения диаграммы.")
             return
 
-        # Создаём диаграмму
-        fig, ax = plt.subplots()
-        ax.pie(totals.values(), labels=totals.keys(), autopct='%1.1f%%', startangle=90)
-        ax.set_title("Структура: Доходы и Расходы")
-
-        # Сохраняем в буфер
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png')
-        buf.seek(0)
-        plt.close(fig)
-
-        await update.message.reply_photo(photo=buf)
+        # рисуется в отдельном процессе, event loop в это время обслуживает остальных
+        png = await charts.render_chart(kind, data)
+        await sender.run(update.effective_chat.id, update.message.reply_photo, photo=png)
 
+    except ledger.LedgerSyncPending:
+        await reply_with_retry(update, "⏳ Операции ещё сохраняются в таблицу, попробуйте через минуту.")
     except Exception as e:
         logger.exception("Ошибка при построении диаграммы")
         await reply_with_retry(update, "⚠️ Не удалось построить диаграмму.")
 
 
-def perform_web_search(query: str) -> str:
+# Сводка доходов и расходов по месяцам и валютам (из нарастающих сумм ledger)
+async def send_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        with DDGS() as ddgs:
-            results = ddgs.text(query, region='wt-wt', safesearch='moderate', max_results=5)
-            snippets = []
-            for res in results:
-                title = res.get("title", "")
-                body = res.get("body", "")
-                url = res.get("href", "")
-                snippets.append(f"{title}\n{body}\n{url}")
-            return "\n\n---\n\n".join(snippets) if snippets else "По результату ничего не найдено."
+        user_id = update.effective_user.id
+        totals = await ledger.monthly_totals(user_id)
+        if not totals:
+            await reply_with_retry(update, "Нет данных для сводки.")
+            return
+
+        # месяц -> категория -> [«сумма валюта», ...]
+        months: dict[str, dict[str, list[str]]] = {}
+        for (month, category, currency), total in sorted(totals.items()):
+            months.setdefault(month, {}).setdefault(category, []).append(f"{total:,.2f} {currency}".replace(",", " "))
+
+        lines = ["📊 Сводка по месяцам:"]
+        for month in sorted(months)[-SUMMARY_MONTHS:]:
+            lines.append(f"\n{month}")
+            for category, amounts in months[month].items():
+                lines.append(f"• {category}: {', '.join(amounts)}")
+        await reply_with_retry(update, "\n".join(lines))
+
+    except ledger.LedgerSyncPending:
+        await reply_with_retry(update, "⏳ Операции ещё сохраняются в таблицу, попробуйте через минуту.")
     except Exception as e:
-        logger.error(f"Ошибка поиска DuckDuckGo: {e}")
-        return "⚠️ Ошибка при поиске в интернете."
+        logger.exception("Ошибка при построении сводки")
+        await reply_with_retry(update, "⚠️ Не удалось построить сводку.")
+
+
+# /stats — счётчики работы бота, только для администраторов из ADMIN_IDS
+# (пустой список — команда недоступна никому)
+async def send_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await reply_with_retry(update, "Команда доступна только администратору.")
+        return
+    snap = metrics.snapshot()
+    counters = snap["counters"]
+    lines = [f"📈 Статистика (аптайм {snap['uptime_sec'] // 3600} ч {snap['uptime_sec'] % 3600 // 60} мин):"]
+    lines += [f"• {name}: {value}" for name, value in counters.items()]
+    lines += [f"• {name}: {value:g}" for name, value in snap["gauges"].items()]
+    # сколько сообщений обошлось без вызова модели-классификатора
+    total = sum(counters.get(f"classifier.{k}", 0) for k in ("skip", "local", "llm"))
+    if total:
+        saved = total - counters.get("classifier.llm_calls", 0)
+        lines.append(f"\nКлассификатор: {saved} из {total} сообщений без обращения к модели ({saved / total:.0%}).")
+    lookups = counters.get("classifier.cache_hit", 0) + counters.get("classifier.cache_miss", 0)
+    if lookups:
+        lines.append(f"Кэш классификатора: {counters.get('classifier.cache_hit', 0) / lookups:.0%} попаданий.")
+    gauges = snap["gauges"]
+    if gauges.get("sessions.limit_bytes"):
+        lines.append(f"Контексты в памяти: {gauges.get('sessions.count', 0):g}, "
+                     f"{gauges.get('sessions.bytes', 0) / 2**20:.1f} из {gauges['sessions.limit_bytes'] / 2**20:.0f} МБ.")
+    await reply_with_retry(update, "\n".join(lines))
+
+
+async def perform_web_search(query: str) -> str:
+    # поиск с кэшем и объединением одинаковых запросов (см. search_client)
+    return await web_search(query)
 
 
 # Функция для получения данных из Google Sheets
 def get_google_sheet_data():
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_name(config.GOOGLE_CREDENTIALS_PATH, scope)
-    client = gspread.authorize(creds)
-
-    spreadsheet = client.open("FinanceData")  # Название таблицы в Google Sheets
+    spreadsheet = get_spreadsheet()  # общая закэшированная таблица config.SHEET_NAME
     worksheet = spreadsheet.get_worksheet(0)  # Получаем первый лист
     records = worksheet.get_all_records()  # Получаем все записи из таблицы
 
     return records
 
-# Функция для выгрузки в Excel
+# разбирает дату из аргумента /export: ГГГГ-ММ-ДД или ДД.ММ.ГГГГ
+def _parse_export_date(value: str) -> datetime | None:
+    for fmt in ("%Y-%m-%d", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+# Функция для выгрузки операций: /export [xlsx|csv|parquet] [с] [по]
+# (например: /export csv 2024-01-01 2024-03-31)
 async def export_to_excel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
-        worksheet = get_or_create_sheet_for_user(user_id)
-        records = worksheet.get_all_records()
+        args = list(context.args or [])
+        fmt = args.pop(0).lower() if args and args[0].lower() in EXPORT_FORMATS else "xlsx"
 
-        if not records:
-            await reply_with_retry(update, "⚠️ Нет данных для выгрузки.")
+        dates = [_parse_export_date(arg) for arg in args[:2]]
+        if len(args) > 2 or None in dates:
+            await reply_with_retry(update, "Формат: /export [xlsx|csv|parquet] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД]")
             return
+        date_from = dates[0].strftime("%Y-%m-%d 00:00:00") if len(dates) > 0 else None
+        date_to = dates[1].strftime("%Y-%m-%d 23:59:59") if len(dates) > 1 else None
 
-        df = pd.DataFrame(records)
+        # строки читаются из локального зеркала порциями и пишутся в буфер в рабочем потоке
+        await ledger.ensure_synced(user_id)
+        data, count = await asyncio.to_thread(
+            build_export, ledger.iter_rows(user_id, date_from, date_to), fmt
+        )
 
-        if df.empty:
-            await reply_with_retry(update, "⚠️ Ошибка: не удалось извлечь данные для выгрузки.")
+        if not count:
+            await reply_with_retry(update, "⚠️ Нет данных для выгрузки.")
             return
 
-        # Формируем системно-независимый путь
-        file_path = config.LOG_DIR / f"finance_data_{user_id}.xlsx"
-
-        # Убедимся, что папка существует
-        file_path.parent.mkdir(parents=True, exist_ok=True)
-
-        df.to_excel(file_path, index=False)
-
-        await update.message.reply_document(document=open(file_path, 'rb'))
+        await sender.run(update.effective_chat.id, update.message.reply_document,
+                         document=data, filename=f"finance_data_{user_id}.{fmt}")
 
+    except ExportError as e:
+        await reply_with_retry(update, f"⚠️ {e}")
+    except ledger.LedgerSyncPending:
+        await reply_with_retry(update, "⏳ Операции ещё сохраняются в таблицу, попробуйте через минуту.")
     except Exception as e:
-        logger.error(f"Ошибка при выгрузке данных в Excel: {e}")
-        await reply_with_retry(update, "⚠️ Ошибка при выгрузке данных в Excel.")
+        logger.error(f"Ошибка при выгрузке данных: {e}")
+        await reply_with_retry(update, "⚠️ Ошибка при выгрузке данных.")
 
 # Функция для подтверждения ввода в таблицу личных финансовых записей
 async def confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -620,19 +819,19 @@ async def confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
 
     # отмена по таймауту или без запроса
-    if user_id not in pending:
+    # (забираем и сразу очищаем, чтобы повторное нажатие не записало операции дважды)
+    rows = pending.pop(user_id)
+    if rows is None:
         await query.answer("Нет операций для подтверждения.", show_alert=True)
         return
 
     if query.data == "confirm_yes":
-        # записываем
-        write_valid_data(user_id, query.from_user.username or "без_ника", pending[user_id])
-        await query.edit_message_text("✅ Операция(и) записаны.")
+        # записываем в таблицу и в локальное зеркало операций
+        await write_valid_data(user_id, query.from_user.username or "без_ника", rows)
+        await ledger.record_rows(user_id, rows)
+        await sender.run(user_id, query.edit_message_text, "✅ Операция(и) записаны.")
     else:
-        await query.edit_message_text("❌ Операции отменены.")
-
-    # очищаем
-    del pending[user_id]
+        await sender.run(user_id, query.edit_message_text, "❌ Операции отменены.")
 
 async def on_search_continue(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # пользователь нажал «Продолжить поиск» — продолжаем цикл SEARCH."""
@@ -654,21 +853,69 @@ def notify_admin(message: str):
     # Заглушка под будущее: можно отправлять в Telegram, email или лог-сервис
     logger.warning(f"[Уведомление админу] {message}")
 
+# фоновые службы запускаются вместе с приложением и останавливаются вместе с ним
+_warmup_tasks: set[asyncio.Task] = set()
+
+async def post_init(application):
+    sheet_writer.start()
+    ledger.start()
+    rates_table.start()
+    _sweeper.start()
+    # модели и процессы для диаграмм поднимаются в фоне: бот начинает принимать
+    # сообщения сразу, а первый запрос при необходимости сам дождётся инициализации
+    for coro in (ai_client.warm_up(), charts.start()):
+        task = asyncio.create_task(coro)
+        _warmup_tasks.add(task)
+        task.add_done_callback(_warmup_done)
+
+def _warmup_done(task: asyncio.Task):
+    _warmup_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Ошибка фоновой инициализации: {task.exception()}")
+
+async def post_shutdown(application):
+    await ledger.stop()
+    await rates_table.stop()
+    await _sweeper.stop()
+    await page_fetcher.close()
+    user_histories.flush()      # несохранённые реплики дописываются на диск
+    charts.stop()
+    await sheet_writer.stop()   # дописываем в таблицу всё, что ещё в очереди
+
+
+# === Сборка приложения ===
+def build_application(webhook: bool = False):
+    builder = (
+        ApplicationBuilder()
+        .token(config.TELEGRAM_BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(True)
+    )
+    if webhook:
+        # апдейты приходят из webhook.py, опрашивать Telegram не нужно
+        builder = builder.updater(None)
+    app = builder.build()
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("reset", reset_history))
+    app.add_handler(CommandHandler("chart", send_pie_chart))
+    app.add_handler(CommandHandler("summary", send_summary))
+    app.add_handler(CommandHandler("stats", send_stats))
+    app.add_handler(CommandHandler("search", search_command))
+    app.add_handler(CommandHandler("export", export_to_excel))
+    app.add_handler(CallbackQueryHandler(on_search_continue, pattern="continue_search"))
+    app.add_handler(CallbackQueryHandler(on_search_stop, pattern="stop_search"))
+    app.add_handler(CallbackQueryHandler(confirm_callback))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND , handle_message))
+    app.add_error_handler(error_handler)
+    return app
+
+
 # === Запуск бота ===
 if __name__ == '__main__':
     try:
-        app = ApplicationBuilder().token(config.TELEGRAM_BOT_TOKEN).build()
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("help", help_command))
-        app.add_handler(CommandHandler("reset", reset_history))
-        app.add_handler(CommandHandler("chart", send_pie_chart))
-        app.add_handler(CommandHandler("search", search_command))
-        app.add_handler(CommandHandler("export", export_to_excel))
-        app.add_handler(CallbackQueryHandler(on_search_continue, pattern="continue_search"))
-        app.add_handler(CallbackQueryHandler(on_search_stop, pattern="stop_search"))
-        app.add_handler(CallbackQueryHandler(confirm_callback))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND , handle_message))
-        app.add_error_handler(error_handler)
+        app = build_application()
         logger.info("Бот запущен")
         app.run_polling()
     except Exception as e:
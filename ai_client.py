@@ -1,80 +1,481 @@
 ﻿# ai_client.py - файл для доступа к AI-клиентам
 import os
+import asyncio
 import logging
-import vertexai
-import google.generativeai as genai
-from google.api_core.exceptions import FailedPrecondition
-from vertexai.language_models import TextGenerationModel, ChatModel
-from config import PROJECT_ID, SA_KEY_PATH, GEMINI_API_KEY
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import (
+    PROJECT_ID, SA_KEY_PATH, GEMINI_API_KEY,
+    LLM_MAX_CONCURRENCY, LLM_PER_USER_CONCURRENCY, LLM_TIMEOUT_SEC,
+    LLM_STATS_WINDOW, LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN_SEC,
+    LLM_HEDGE_ENABLED, LLM_HEDGE_MIN_SAMPLES
+)
+import metrics
 
 logger = logging.getLogger(__name__)
 
-# заготовки для моделей
+# заготовки для моделей: SDK импортируются и модели создаются не при импорте модуля,
+# а при первом обращении или в фоне после запуска бота (см. warm_up)
 model = None
 classification_model = None
 genai_model = None
 genai_class_model = None
+_init_lock = threading.Lock()
+_initialized = False
 
-# === Настройка Vertex AI Gemini (платный) ===
-try:
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SA_KEY_PATH
-    vertexai.init(project=PROJECT_ID, location="asia-southeast1")
-    model = TextGenerationModel.from_pretrained("gemini-1.5-flash")
-    classification_model = ChatModel.from_pretrained("gemini-1.5-flash")
-except Exception as e:
-    logger.error(f"[ai_client] Ошибка инициализации Vertex AI: {e}")
-
-# === Настройка GenAI (бесплатный)  ===
-try:
-    genai.configure(api_key=GEMINI_API_KEY)
-    genai_model = genai.GenerativeModel("gemini-1.5-flash")
-    genai_class_model = genai.GenerativeModel("gemini-1.5-flash")
-    logger.info("[ai_client] GenAI инициализирована")
-except Exception as e:
-    logger.error(f"[ai_client] Ошибка инициализации GenAI: {e}")
 
+def init_models() -> None:
+    # однократная инициализация моделей; безопасна при вызове из нескольких потоков
+    global model, classification_model, genai_model, genai_class_model, _initialized
+    if _initialized:
+        return
+    with _init_lock:
+        if _initialized:
+            return
+        started = time.monotonic()
 
-def text_completion(prompt: str) -> str:
-    # сначала пробуем вызвать БЕСплатный GenAI
-    if genai_model:
+        # === Настройка Vertex AI Gemini (платный) ===
+        try:
+            import vertexai
+            from vertexai.language_models import TextGenerationModel, ChatModel
+            os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SA_KEY_PATH
+            vertexai.init(project=PROJECT_ID, location="asia-southeast1")
+            model = TextGenerationModel.from_pretrained("gemini-1.5-flash")
+            classification_model = ChatModel.from_pretrained("gemini-1.5-flash")
+        except Exception as e:
+            logger.error(f"[ai_client] Ошибка инициализации Vertex AI: {e}")
+
+        # === Настройка GenAI (бесплатный)  ===
         try:
-            return genai_model.generate_content(prompt).text
-        except FailedPrecondition as e:
-            logger.warning(f"[ai_client] GenAI location error, falling back to Vertex if available: {e}")
-            # попытка вызова платного Vertex AI
-            if model:
-                return model.predict(prompt).text
-            # если и платный недоступен — прокидываем ошибку дальше
-            raise RuntimeError("Нет доступной текстовой модели Gemini!")
+            import google.generativeai as genai
+            genai.configure(api_key=GEMINI_API_KEY)
+            genai_model = genai.GenerativeModel("gemini-1.5-flash")
+            genai_class_model = genai.GenerativeModel("gemini-1.5-flash")
+            logger.info("[ai_client] GenAI инициализирована")
+        except Exception as e:
+            logger.error(f"[ai_client] Ошибка инициализации GenAI: {e}")
+
+        _initialized = True
+        metrics.set_gauge("llm.init_sec", round(time.monotonic() - started, 3))
+
+
+async def warm_up() -> None:
+    # инициализация моделей в пуле потоков, чтобы не блокировать event loop
+    if not _initialized:
+        await asyncio.get_running_loop().run_in_executor(_llm_executor, init_models)
+
+
+# === Вызовы конкретных моделей ===
+
+def _genai_text(prompt: str) -> str:
+    return genai_model.generate_content(prompt).text
+
+
+def _vertex_text(prompt: str) -> str:
+    return model.predict(prompt).text
+
+
+def _genai_chat(system_prompt: str, user_prompt: str) -> str:
+    combined = system_prompt + "\n\n" + user_prompt
+    return genai_class_model.generate_content(combined).text
+
+
+def _vertex_chat(system_prompt: str, user_prompt: str) -> str:
+    chat = classification_model.start_chat()
+    chat.append_system_message(system_prompt)
+    chat.append_user_message(user_prompt)
+    return chat.send_message().text
+
+
+# === Маршрутизация между GenAI (бесплатный) и Vertex AI (платный) ===
+# Для каждого backend'а ведётся скользящая статистика задержек и ошибок. После серии
+# ошибок backend выключается на LLM_BREAKER_COOLDOWN_SEC (circuit breaker), затем
+# получает один пробный запрос: пока он не вернулся, остальные вызовы идут мимо, при
+# ошибке backend снова выключается, при успехе — включается полностью. Любая ошибка основного backend'а ведёт к запасному, а если
+# основной отвечает дольше своего p95 — запасному параллельно уходит страхующий
+# (hedged) запрос, и берётся тот ответ, что пришёл первым.
+
+class BackendUnavailable(Exception):
+    # backend выключен или уже обрабатывает пробный запрос после паузы
+    pass
+
+
+class BackendHealth:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: deque[float] = deque(maxlen=LLM_STATS_WINDOW)   # только успешные вызовы
+        self.results: deque[bool] = deque(maxlen=LLM_STATS_WINDOW)      # True — успех
+        self.failures = 0           # ошибок подряд
+        self.open_until = 0.0       # до этого момента backend выключен (0 — включён)
+        self.trial_at: float | None = None  # когда после паузы выпущен пробный запрос
+        self._lock = threading.Lock()
+
+    def _admits(self, now: float) -> bool:
+        if not self.open_until:
+            return True
+        if now < self.open_until:
+            return False
+        # пробный запрос, не вернувшийся за LLM_TIMEOUT_SEC, считается потерянным
+        return self.trial_at is None or now - self.trial_at >= LLM_TIMEOUT_SEC
+
+    def available(self) -> bool:
+        # можно ли ставить backend в очередь кандидатов (сам вызов — только после admit)
+        with self._lock:
+            return self._admits(time.monotonic())
+
+    def admit(self) -> bool:
+        # вызывается непосредственно перед запросом: после паузы пропускает только один
+        with self._lock:
+            now = time.monotonic()
+            if not self._admits(now):
+                return False
+            if self.open_until:
+                self.trial_at = now
+            return True
+
+    def error_rate(self) -> float:
+        return self.results.count(False) / len(self.results) if self.results else 0.0
+
+    def p95(self) -> float | None:
+        if len(self.latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None     # статистики мало — не страхуем
+        ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def record(self, ok: bool, latency: float) -> None:
+        with self._lock:
+            self.results.append(ok)
+            metrics.set_gauge(f"llm.{self.name}.error_rate", round(self.error_rate(), 3))
+            if ok:
+                self.latencies.append(latency)
+                self.failures = 0
+                if self.open_until:
+                    logger.info(f"[ai_client] {self.name} снова включён")
+                self.open_until, self.trial_at = 0.0, None
+                p95 = self.p95()
+                if p95 is not None:
+                    metrics.set_gauge(f"llm.{self.name}.p95_sec", round(p95, 3))
+                return
+            self.failures += 1
+            too_many = self.failures >= LLM_BREAKER_FAILURES
+            too_often = len(self.results) >= 10 and self.error_rate() > 0.5
+            # пробный запрос после паузы не удался — сразу выключаем снова
+            if too_many or too_often or self.open_until:
+                self.trial_at = None
+                self.open_until = time.monotonic() + LLM_BREAKER_COOLDOWN_SEC
+                metrics.inc("llm.breaker_open")
+                logger.warning(f"[ai_client] {self.name} отключён на {LLM_BREAKER_COOLDOWN_SEC} с "
+                               f"(ошибок подряд: {self.failures}, доля ошибок: {self.error_rate():.0%})")
+
+
+class BackendRouter:
+    def __init__(self, kind: str, backends: list[tuple], no_backend_error: str):
+        # backends: [(имя, функция вызова, функция «модель настроена?»)] в порядке предпочтения
+        self.kind = kind
+        self.backends = backends
+        self.no_backend_error = no_backend_error
+        self.health = {name: BackendHealth(f"{kind}/{name}") for name, _, _ in backends}
+
+    def candidates(self) -> list[tuple[str, object]]:
+        # настроенные и не выключенные backend'ы в порядке предпочтения. Выключенные не
+        # пробуем даже в крайнем случае: иначе при сбое всех backend'ов каждый вызов
+        # бил бы в сбойный, и пробный запрос после паузы терял бы смысл
+        init_models()
+        return [(name, func) for name, func, ready in self.backends
+                if ready() and self.health[name].available()]
+
+    def _timed(self, name: str, func, *args):
+        if not self.health[name].admit():
+            raise BackendUnavailable(f"{self.kind}/{name} временно отключён")
+        started = time.monotonic()
+        try:
+            result = func(*args)
+        except Exception:
+            self.health[name].record(False, time.monotonic() - started)
+            raise
+        self.health[name].record(True, time.monotonic() - started)
+        return result
+
+    def call(self, *args):
+        # синхронный вызов: backend'ы по очереди, пока кто-то не ответит
+        error = None
+        for name, func in self.candidates():
+            try:
+                return self._timed(name, func, *args)
+            except Exception as e:
+                logger.warning(f"[ai_client] Ошибка {self.kind}/{name}, пробуем следующий backend: {e}")
+                error = e
+        raise error or RuntimeError(self.no_backend_error)
+
+    async def call_async(self, *args, user_id: int | None = None, timeout: float | None = None):
+        timeout = LLM_TIMEOUT_SEC if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        await warm_up()
+        queue = self.candidates()
+        if not queue:
+            raise RuntimeError(self.no_backend_error)
+        deadline = loop.time() + timeout
+        running: dict[asyncio.Future, str] = {}
+        hedge_name = None
+        error = None
+
+        async def launch(name, func):
+            # слот ждём не дольше общего дедлайна: запрос, запущенный после него, только
+            # потратил бы квоту — его ответ уже никто не ждёт.
+            # Слоты освобождаются, только когда поток действительно завершился: поток после
+            # таймаута прервать нельзя, и иначе лимит перестал бы отражать реальную нагрузку
+            try:
+                release = await _acquire_slots(user_id, deadline)
+            except asyncio.TimeoutError:
+                metrics.inc("llm.slot_timeouts")
+                logger.warning(f"[ai_client] Превышен таймаут {timeout} с для {self.kind}: "
+                               f"не дождались свободного слота для {name}")
+                raise
+            fut = loop.run_in_executor(_llm_executor, self._timed, name, func, *args)
+            fut.add_done_callback(release)
+            fut.add_done_callback(_consume_result)
+            running[fut] = name
+
+        await launch(*queue.pop(0))
+        hedge_at = None
+        if queue and LLM_HEDGE_ENABLED:
+            p95 = self.health[next(iter(running.values()))].p95()
+            hedge_at = loop.time() + p95 if p95 is not None else None
 
-    # Если GenAI не настроен, пробуем Vertex
-    if model:
-        return model.predict(prompt).text
-    raise RuntimeError("Нет доступной текстовой модели Gemini!")
+        while running:
+            wake = deadline if hedge_at is None else min(deadline, hedge_at)
+            done, _ = await asyncio.wait(running, timeout=max(0.0, wake - loop.time()),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                name = running.pop(fut)
+                if fut.exception() is None:
+                    if name == hedge_name:
+                        metrics.inc("llm.hedge_wins")
+                    return fut.result()
+                error = fut.exception()
+                logger.warning(f"[ai_client] Ошибка {self.kind}/{name}: {error}")
+                if queue and not running:
+                    metrics.inc("llm.fallbacks")
+                    await launch(*queue.pop(0))
+                    hedge_at = None
+            if done:
+                continue
+            if loop.time() >= deadline:
+                logger.warning(f"[ai_client] Превышен таймаут {timeout} с для {self.kind}")
+                raise asyncio.TimeoutError()
+            # основной backend медленнее своего p95 — страхуем запросом к следующему,
+            # если свободны и общий, и пользовательский слоты (ради страховки в очереди не стоим)
+            hedge_at = None
+            if queue and _slots_free(user_id):
+                metrics.inc("llm.hedged")
+                hedge_name = queue[0][0]
+                await launch(*queue.pop(0))
+        raise error or RuntimeError(self.no_backend_error)
 
 
+def _consume_result(fut) -> None:
+    # результат проигравшего страхующего запроса никому не нужен, но исключение
+    # из него надо «забрать», иначе asyncio ругается в лог
+    if not fut.cancelled():
+        fut.exception()
+
+
+text_router = BackendRouter(
+    "text",
+    [("genai", _genai_text, lambda: genai_model is not None),
+     ("vertex", _vertex_text, lambda: model is not None)],
+    "Нет доступной текстовой модели Gemini!"
+)
+chat_router = BackendRouter(
+    "chat",
+    [("genai", _genai_chat, lambda: genai_class_model is not None),
+     ("vertex", _vertex_chat, lambda: classification_model is not None)],
+    "Нет доступного чат-классификатора Gemini!"
+)
+
+
+def text_completion(prompt: str) -> str:
+    # сначала пробуем БЕСплатный GenAI, при ошибке — платный Vertex AI
+    return text_router.call(prompt)
+
+
+def _chunk_text(chunk) -> str:
+    # у служебных кусков потока (например, с причиной остановки) текста нет
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+
+def text_completion_stream(prompt: str):
+    # то же, что text_completion, но отдаёт ответ кусками по мере генерации.
+    # Переключиться на другой backend можно, только пока ничего не отдано
+    error = None
+    for name, _ in text_router.candidates():
+        if not text_router.health[name].admit():
+            error = BackendUnavailable(f"text/{name} временно отключён")
+            continue
+        started, yielded = time.monotonic(), False
+        try:
+            if name == "genai":
+                for chunk in genai_model.generate_content(prompt, stream=True):
+                    text = _chunk_text(chunk)
+                    if text:
+                        yielded = True
+                        yield text
+            else:
+                # Vertex-модель отдаёт ответ целиком, одним куском
+                yielded = True
+                yield model.predict(prompt).text
+        except Exception as e:
+            text_router.health[name].record(False, time.monotonic() - started)
+            if yielded:
+                raise
+            logger.warning(f"[ai_client] Ошибка text/{name}, пробуем следующий backend: {e}")
+            error = e
+            continue
+        text_router.health[name].record(True, time.monotonic() - started)
+        return
+    raise error or RuntimeError(text_router.no_backend_error)
+
 
 def chat_completion(system_prompt: str, user_prompt: str) -> str:
-    # сначала пробуем вызвать БЕСплатный GenAI
-    if genai_class_model:
+    # сначала пробуем БЕСплатный GenAI, при ошибке — платный Vertex AI
+    return chat_router.call(system_prompt, user_prompt)
+
+
+# === Асинхронный слой поверх блокирующих SDK ===
+# SDK Gemini синхронные, поэтому вызовы уходят в ограниченный пул потоков,
+# а event loop бота продолжает обслуживать остальных пользователей.
+_llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="llm")
+_global_limit = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+# user_id -> [семафор, число активных/ожидающих вызовов]
+_user_limits: dict[int, list] = {}
+
+
+def _acquire_user_limit(user_id: int) -> asyncio.Semaphore:
+    entry = _user_limits.get(user_id)
+    if entry is None:
+        entry = _user_limits[user_id] = [asyncio.Semaphore(LLM_PER_USER_CONCURRENCY), 0]
+    entry[1] += 1
+    return entry[0]
+
+
+def _release_user_limit(user_id: int, acquired: bool = True) -> None:
+    entry = _user_limits.get(user_id)
+    if entry is None:
+        return
+    if acquired:
+        entry[0].release()
+    entry[1] -= 1
+    if entry[1] <= 0:
+        del _user_limits[user_id]   # не копим семафоры всех когда-либо писавших пользователей
+
+
+def _slots_free(user_id: int | None) -> bool:
+    # можно ли занять слоты прямо сейчас, не вставая в очередь
+    if _global_limit.locked():
+        return False
+    entry = _user_limits.get(user_id) if user_id is not None else None
+    return entry is None or not entry[0].locked()
+
+
+async def _acquire_slots(user_id: int | None, deadline: float | None = None):
+    # занимает глобальный и пользовательский слоты; возвращает функцию их освобождения.
+    # deadline (по часам event loop'а) — после него ждать слот уже незачем: TimeoutError
+    loop = asyncio.get_running_loop()
+
+    async def _wait(sem: asyncio.Semaphore) -> None:
+        if deadline is None:
+            await sem.acquire()
+            return
+        left = deadline - loop.time()
+        if left <= 0:
+            raise asyncio.TimeoutError()
+        await asyncio.wait_for(sem.acquire(), left)
+
+    user_sem = None
+    if user_id is not None:
+        user_sem = _acquire_user_limit(user_id)
+        try:
+            await _wait(user_sem)
+        except BaseException:
+            _release_user_limit(user_id, acquired=False)
+            raise
+    try:
+        await _wait(_global_limit)
+    except BaseException:
+        if user_sem is not None:
+            _release_user_limit(user_id)
+        raise
+
+    def _release(_=None):
+        _global_limit.release()
+        if user_sem is not None:
+            _release_user_limit(user_id)
+
+    return _release
+
+
+async def async_text_completion(prompt: str, user_id: int | None = None,
+                                timeout: float | None = None) -> str:
+    return await text_router.call_async(prompt, user_id=user_id, timeout=timeout)
+
+
+async def async_chat_completion(system_prompt: str, user_prompt: str, user_id: int | None = None,
+                                timeout: float | None = None) -> str:
+    return await chat_router.call_async(system_prompt, user_prompt, user_id=user_id, timeout=timeout)
+
+
+async def async_text_completion_stream(prompt: str, user_id: int | None = None,
+                                       timeout: float | None = None):
+    # асинхронный генератор кусков ответа. Поток SDK кладёт куски в очередь event loop'а;
+    # если потребитель закрыл генератор раньше (например, увидел SEARCH:), поток
+    # перестаёт читать ответ модели на следующем куске. timeout — на весь ответ целиком.
+    timeout = LLM_TIMEOUT_SEC if timeout is None else timeout
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def _put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            pass    # event loop уже закрыт — отдавать куски некому
+
+    def _produce():
         try:
-            combined = system_prompt + "\n\n" + user_prompt
-            return genai_class_model.generate_content(combined).text
-        except FailedPrecondition as e:
-            logger.warning(f"[ai_client] GenAI chat location error: {e}")
-            # попытка вызова платногоVertex AI
-            if classification_model:
-                chat = classification_model.start_chat()
-                chat.append_system_message(system_prompt)
-                chat.append_user_message(user_prompt)
-                return chat.send_message().text
-            raise RuntimeError("Нет доступного чат-классификатора Gemini!")
-
-    # Если GenAI-чат не настроен, пробуем платный Vertex-чат
-    if classification_model:
-            chat = classification_model.start_chat()
-            chat.append_system_message(system_prompt)
-            chat.append_user_message(user_prompt)
-            return chat.send_message().text
-    raise RuntimeError("Нет доступного чат-классификатора Gemini!")
+            for chunk in text_completion_stream(prompt):
+                if stop.is_set():
+                    break
+                _put((chunk, None))
+        except Exception as e:
+            _put((None, e))
+        else:
+            _put((None, None))
 
+    deadline = loop.time() + timeout
+    try:
+        release = await _acquire_slots(user_id, deadline)
+    except asyncio.TimeoutError:
+        metrics.inc("llm.slot_timeouts")
+        logger.warning(f"[ai_client] Превышен таймаут {timeout} с для text_completion_stream: "
+                       "не дождались свободного слота")
+        raise
+    fut = loop.run_in_executor(_llm_executor, _produce)
+    fut.add_done_callback(release)
+    try:
+        while True:
+            chunk, error = await asyncio.wait_for(queue.get(), max(0.0, deadline - loop.time()))
+            if error is not None:
+                raise error
+            if chunk is None:
+                return
+            yield chunk
+    except asyncio.TimeoutError:
+        logger.warning(f"[ai_client] Превышен таймаут {timeout} с для text_completion_stream")
+        raise
+    finally:
+        stop.set()
@@ -0,0 +1,79 @@
+﻿# bench_search.py - проверка поискового этапа на локальном HTTP-сервере (без DuckDuckGo и интернета)
+# Запуск: python bench_search.py [--queries 3] [--pages 2] [--delay 0.5]
+# Сервер отдаёт синтетические страницы с задержкой --delay; результаты поиска подставляются
+# вместо ответа DuckDuckGo, дальше работает настоящий путь: загрузка через пул соединений,
+# извлечение текста в пуле процессов и отбор источников (search_client.collect_sources).
+import argparse
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import page_fetcher
+import search_client
+
+_TOPICS = ["курс доллара", "ставки по вкладам", "доходность ОФЗ", "цена нефти", "индекс мосбиржи"]
+
+
+def _page(topic: str, n: int) -> str:
+    filler = " ".join(["Общие сведения о рынке и экономике без прямого отношения к теме."] * 4)
+    return (
+        "<html><head><title>{t}</title><script>var x = 1;</script></head><body>"
+        "<nav>Главная | Новости | Контакты | Войти</nav>"
+        "<article><h1>{t}: обзор №{n}</h1>"
+        "<p>{f}</p><p>Сегодня {t} изменился: аналитики отмечают, что {t} зависит от решений ЦБ.</p>"
+        "<p>{f}</p></article><footer>© Синтетический сайт</footer></body></html>"
+    ).format(t=topic, n=n, f=filler)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    delay = 0.0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        topic, n = self.path.strip("/").split("/")
+        body = _page(_TOPICS[int(topic)], int(n)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+async def _run(base: str, queries: int, pages: int) -> None:
+    topics = _TOPICS[:queries]
+    results = [
+        [{"title": f"{topic} — источник {n}", "body": f"Кратко: {topic}.", "url": f"{base}/{q}/{n}"}
+         for n in range(pages)]
+        for q, topic in enumerate(topics)
+    ]
+    started = time.perf_counter()
+    context = search_client.format_sources(await search_client.collect_sources(topics, results))
+    elapsed = time.perf_counter() - started
+    await page_fetcher.close()
+    print(f"Запросов: {queries}, страниц: {queries * pages}, этап занял {elapsed:.2f} с")
+    print(f"Размер контекста: {len(context)} символов\n")
+    print(context)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Проверка поискового этапа на локальном сервере")
+    parser.add_argument("--queries", type=int, default=3, help=f"запросов (не больше {len(_TOPICS)})")
+    parser.add_argument("--pages", type=int, default=2, help="страниц на запрос")
+    parser.add_argument("--delay", type=float, default=0.5, help="задержка ответа сервера, с")
+    args = parser.parse_args()
+
+    _Handler.delay = args.delay
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        asyncio.run(_run(f"http://127.0.0.1:{server.server_port}", min(args.queries, len(_TOPICS)), args.pages))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+﻿# bench_startup.py - замер времени холодного запуска бота (импорт модулей и сборка приложения)
+# Запуск: python bench_startup.py [-n 5] [--top 15]
+# Каждый прогон — отдельный процесс с -X importtime, чтобы кэш импортов не искажал результат.
+import argparse
+import statistics
+import subprocess
+import sys
+
+_PROBE = (
+    "import time; t = time.perf_counter(); "
+    "import BestJarvisAI_Bot as bot; t_import = time.perf_counter() - t; "
+    "bot.build_application(); t_total = time.perf_counter() - t; "
+    "print(f'{t_import:.4f} {t_total:.4f}')"
+)
+
+
+def _run_once() -> tuple[float, float, list[tuple[int, str]]]:
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", _PROBE],
+                          capture_output=True, text=True, check=True)
+    t_import, t_total = map(float, proc.stdout.split()[-2:])
+    # строки вида «import time: self [us] | cumulative | imported package»
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        name = name.rstrip()[1:]     # после «|» идёт один пробел, дальше — отступ по 2 на уровень
+        modules.append((int(cumulative), name))
+    return t_import, t_total, modules
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Замер времени запуска бота")
+    parser.add_argument("-n", type=int, default=5, help="сколько прогонов")
+    parser.add_argument("--top", type=int, default=15, help="сколько самых долгих импортов показать")
+    args = parser.parse_args()
+
+    imports, totals, modules = [], [], []
+    for _ in range(args.n):
+        t_import, t_total, modules = _run_once()
+        imports.append(t_import)
+        totals.append(t_total)
+
+    print(f"Импорт BestJarvisAI_Bot: медиана {statistics.median(imports) * 1000:.0f} мс")
+    print(f"Импорт + build_application(): медиана {statistics.median(totals) * 1000:.0f} мс")
+    print("\nСамые долгие импорты (последний прогон, накопительно):")
+    # первый уровень вложенности — модули, которые импортирует сам бот
+    direct = [m for m in modules if m[1].startswith("  ") and not m[1].startswith("    ")]
+    top = sorted(direct, reverse=True)[:args.top]
+    for cumulative, name in top:
+        print(f"{cumulative / 1000:8.1f} мс  {name.strip()}")
+
+
+if __name__ == "__main__":
+    main()
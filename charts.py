@@ -0,0 +1,128 @@
+﻿# charts.py - отрисовка диаграмм в отдельных процессах
+# matplotlib используется напрямую через Figure + Agg (без глобального состояния pyplot)
+# и импортируется только в рабочих процессах, поэтому не замедляет запуск бота.
+# Готовые PNG кэшируются по хэшу входных данных: одинаковые /chart не рисуются повторно.
+# Новый тип диаграммы — это функция data -> PNG, добавленная в RENDERERS.
+import asyncio
+import hashlib
+import io
+import json
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from config import CHART_WORKERS, CHART_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+_pool: ProcessPoolExecutor | None = None
+_cache: OrderedDict[str, bytes] = OrderedDict()
+_inflight: dict[str, asyncio.Future] = {}
+
+
+# === Отрисовка (выполняется в рабочем процессе) ===
+
+def _new_figure(figsize=(6, 6)):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _to_png(fig) -> bytes:
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
+
+
+# круговая диаграмма: {"title": str, "values": {подпись: число}}
+def _render_pie(data: dict) -> bytes:
+    fig = _new_figure()
+    ax = fig.subplots()
+    ax.pie(list(data["values"].values()), labels=list(data["values"].keys()),
+           autopct='%1.1f%%', startangle=90)
+    ax.set_title(data.get("title", ""))
+    return _to_png(fig)
+
+
+# столбцы по месяцам: {"title": str, "months": [..], "series": {подпись: [число на каждый месяц]}}
+def _render_monthly_bars(data: dict) -> bytes:
+    months, series = data["months"], data["series"]
+    fig = _new_figure(figsize=(max(6, len(months) * 0.9), 5))
+    ax = fig.subplots()
+    width = 0.8 / max(1, len(series))
+    for i, (label, values) in enumerate(series.items()):
+        ax.bar([m + i * width for m in range(len(months))], values, width=width, label=label)
+    ax.set_xticks([m + width * (len(series) - 1) / 2 for m in range(len(months))])
+    ax.set_xticklabels(months, rotation=45, ha="right")
+    ax.set_title(data.get("title", ""))
+    ax.legend()
+    fig.tight_layout()
+    return _to_png(fig)
+
+
+RENDERERS = {
+    "pie": _render_pie,
+    "monthly": _render_monthly_bars,
+}
+
+
+def _render(kind: str, data: dict) -> bytes:
+    return RENDERERS[kind](data)
+
+
+def _noop() -> None:
+    pass
+
+
+# === Интерфейс для бота ===
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=CHART_WORKERS)
+    return _pool
+
+
+async def render_chart(kind: str, data: dict) -> bytes:
+    # возвращает PNG диаграммы kind; одинаковые одновременные запросы рисуются один раз
+    if kind not in RENDERERS:
+        raise ValueError(f"Неизвестный тип диаграммы: {kind}")
+    key = hashlib.sha256(
+        json.dumps([kind, data], sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
+
+    png = _cache.get(key)
+    if png is not None:
+        _cache.move_to_end(key)
+        return png
+
+    fut = _inflight.get(key)
+    if fut is None:
+        fut = asyncio.get_running_loop().run_in_executor(_get_pool(), _render, kind, data)
+        _inflight[key] = fut
+        fut.add_done_callback(lambda f: _store(key, f))
+    # shield: отмена одного ожидающего не должна отменять отрисовку для остальных
+    return await asyncio.shield(fut)
+
+
+def _store(key: str, fut: asyncio.Future) -> None:
+    _inflight.pop(key, None)
+    if fut.cancelled() or fut.exception():
+        return
+    _cache[key] = fut.result()
+    while len(_cache) > CHART_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+async def start() -> None:
+    # поднимаем рабочие процессы заранее, пока в боте мало потоков и ничего не ждёт
+    await asyncio.get_running_loop().run_in_executor(_get_pool(), _noop)
+
+
+def stop() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
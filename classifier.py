@@ -0,0 +1,254 @@
+﻿# classifier.py - извлечение личных финансовых операций из сообщений пользователя
+# Перед обращением к модели сообщение проходит локальный фильтр:
+#   - где суммы быть не может («привет», вопросы без чисел) — модель не вызывается вовсе;
+#   - простые однозначные записи («кофе 300 руб») разбираются регулярными выражениями;
+#   - всё остальное уходит классификатору Gemini; сообщения, пришедшие в пределах
+#     короткого окна, отправляются одним пакетным запросом.
+# Счётчики classifier.* в metrics показывают, сколько обращений к модели сэкономлено.
+import asyncio
+import hashlib
+import json
+import logging
+import re
+
+import classifier_cache
+import metrics
+from ai_client import async_chat_completion as _chat_completion
+from config import (
+    CATEGORY_EXPENSE, CATEGORY_INCOME, CATEGORY_INVESTMENT, CURRENCY_MAP,
+    CLASSIFIER_BATCH_WINDOW_SEC, CLASSIFIER_BATCH_MAX_SIZE
+)
+
+logger = logging.getLogger(__name__)
+
+GATE_SKIP = "skip"     # операций в сообщении нет
+GATE_LOCAL = "local"   # простая запись, разбираем сами
+GATE_LLM = "llm"       # неоднозначно, спрашиваем модель
+
+# валюты: сначала длинные ключи, чтобы «рублей» не распознавалось как «руб»
+_CURRENCY_ALT = "|".join(re.escape(k) for k in sorted(CURRENCY_MAP, key=len, reverse=True))
+_NUMBER = r"(?:\d{1,3}(?:[ \u00a0]\d{3})+|\d+)(?:[.,]\d{1,2})?"
+_AMOUNT_RE = re.compile(
+    rf"(?<![\w.,])(?P<amount>{_NUMBER})\s*(?P<currency>{_CURRENCY_ALT})(?![а-яёa-z])"
+    rf"|(?P<currency2>[$€¥₽])\s*(?P<amount2>{_NUMBER})(?![\d.,])"
+)
+_DIGITS_RE = re.compile(r"\d+")
+# суммы прописью и разговорные множители — такие сообщения разбирает только модель.
+# Числительные — только целым словом («сто», но не «стоит»), множители — по основе («тысячи»)
+_NUMBER_WORDS_RE = re.compile(
+    r"\b(?:(?:один|одну|два|две|три|четыре|пять|шесть|семь|восемь|девять|десять|\w+надцать|"
+    r"двадцать|тридцать|сорок|пятьдесят|шестьдесят|семьдесят|восемьдесят|девяносто|"
+    r"сто|двести|триста|четыреста|\w+сот)\b|"
+    r"полтор\w*|тысяч\w*|тыщ\w*|косар\w*|штук\w*|"
+    r"сотн\w*|сотк\w*|миллион\w*|лям\w*|\d+\s*(?:к|тыс|млн|k)\b)"
+)
+# признаки гипотетических, плановых и прочих «не фактических» сумм
+_AMBIGUOUS_WORDS = (
+    "если", " бы ", "хочу", "хотел", "планир", "собира", "можно", "нужно", "надо", "сколько",
+    "будет", "стоит ли", "должен", "долг", "в долг", "перев", "обмен", "кредит", "ипотек",
+    "процент", "%", "курс", "цена", "стоимост", " не ", " нет ", "вместо", " или "
+)
+_INCOME_WORDS = ("зарплат", "зп", "получил", "пришл", "заработ", "доход", "преми", "аванс",
+                 "кэшбэк", "кешбэк", "вернули", "продал", "подарили")
+_INVESTMENT_WORDS = ("акци", "облигац", "вклад", "депозит", "инвест", "брокер", "фонд", "etf", "пиф")
+_MAX_LOCAL_WORDS = 8
+
+
+def gate(message: str) -> str:
+    # решает, может ли в сообщении быть операция и кто её будет разбирать
+    text = f" {message.strip().lower()} "
+    has_digits = bool(_DIGITS_RE.search(text))
+    if not has_digits and not _NUMBER_WORDS_RE.search(text):
+        return GATE_SKIP            # нет ни одного числа — суммы здесь быть не может
+    matches = list(_AMOUNT_RE.finditer(text))
+    if "?" in text and not matches:
+        return GATE_SKIP            # вопрос без суммы с валютой — аналитика, а не запись
+    if len(matches) != 1 or "?" in text or _NUMBER_WORDS_RE.search(text):
+        return GATE_LLM
+    if len(text.split()) > _MAX_LOCAL_WORDS or any(w in text for w in _AMBIGUOUS_WORDS):
+        return GATE_LLM
+    # кроме самой суммы в тексте не должно быть других чисел (даты, количества и т.п.)
+    amount = matches[0].group("amount") or matches[0].group("amount2")
+    if len(_DIGITS_RE.findall(text)) != len(_DIGITS_RE.findall(amount)):
+        return GATE_LLM
+    return GATE_LOCAL
+
+
+def parse_simple(message: str) -> list[dict]:
+    # разбор однозначной записи вида «кофе 300 руб» / «зарплата $1500»
+    text = message.strip()
+    match = _AMOUNT_RE.search(text.lower())
+    if not match:
+        return []
+    amount = (match.group("amount") or match.group("amount2")).replace(" ", "").replace("\u00a0", "")
+    currency = match.group("currency") or match.group("currency2")
+    lowered = text.lower()
+    if any(w in lowered for w in _INVESTMENT_WORDS):
+        category = CATEGORY_INVESTMENT
+    elif any(w in lowered for w in _INCOME_WORDS):
+        category = CATEGORY_INCOME
+    else:
+        category = CATEGORY_EXPENSE
+    return [{
+        "category": category,
+        "amount": amount.replace(",", "."),
+        "currency": CURRENCY_MAP[currency],
+        "text": text,
+    }]
+
+
+# системный промпт классификатора; его хэш — версия для ключей кэша:
+# после правки промпта старые ответы из кэша больше не используются
+_SYSTEM_PROMPT = (
+    "Ты выступаешь в роли классификатора пользовательских сообщений по учёту личных финансов. "
+    "Твоя задача — извлечь **все** упомянутые пользователем **фактические** финансовые операции, "
+    "даже если сумма кажется небольшой или незначительной. "
+    "Не фильтруй и не оценивай, важна ли сумма — если пользователь сообщил о транзакции с числом и валютой, это важно.\n\n"
+    "Извлекай только то, что касается **реальных операций пользователя** (его доходы, расходы, инвестиции). "
+    "Игнорируй гипотетические, шутки, аналитику и вопросы.\n\n"
+    "Для каждого действия укажи:\n"
+    "- category: расход / доход / инвестиции\n"
+    "- amount: число без пробелов\n"
+    "- currency: символ или слово (₽, $, €, юань и т.п.)\n"
+    "- text: короткий фрагмент, откуда взяты данные\n\n"
+    "Формат ответа: JSON-массив словарей, каждый из которых имеет ключи: category, amount, currency, text\n"
+    "Если нет ни одной подходящей операции — верни [].\n\n"
+)
+# пакетный режим: несколько независимых сообщений за один вызов модели
+_BATCH_PROMPT = (
+    "Ниже JSON-массив строк: несколько независимых сообщений разных пользователей. "
+    "Номер сообщения — его индекс в массиве, начиная с 0. "
+    "Разбирай каждое сообщение отдельно по правилам выше.\n"
+    "Формат ответа: JSON-объект, где ключ — номер сообщения (строкой), а значение — JSON-массив "
+    "операций этого сообщения в описанном формате ([] если операций нет). "
+    "Ключи должны быть у всех сообщений."
+)
+PROMPT_VERSION = hashlib.sha256((_SYSTEM_PROMPT + _BATCH_PROMPT).encode()).hexdigest()[:12]
+
+
+# далее классифицируем сообщение пользователя, чтобы
+# личные финансы внести в Google-таблицу через API.
+# Возвращает None, если модель не ответила или ответ не разобран (такое не кэшируем)
+async def llm_extract_items(message: str, user_id: int | None = None) -> list[dict] | None:
+    metrics.inc("classifier.llm_calls")
+    try:
+        system_prompt = _SYSTEM_PROMPT + f"Сообщение: {message}"
+
+        raw_text = await _chat_completion(system_prompt, message, user_id=user_id)
+        logger.info(f"Ответ Gemini на классификацию: {raw_text}")
+
+        # Вырезаем только JSON между ```json ... ```
+        match = re.search(r"```(?:json)?\s*(\[.*?\])\s*```", raw_text, re.DOTALL)
+        json_text = match.group(1) if match else raw_text.strip()
+
+        parsed = json.loads(json_text)
+        return parsed if isinstance(parsed, list) else []
+    except Exception as e:
+        logger.error(f"Ошибка разбора JSON в extract_financial_items: {e}")
+        return None
+
+
+async def llm_extract_batch(messages: list[str], user_id: int | None = None) -> list[list[dict] | None]:
+    # разбор нескольких сообщений одним запросом; None — для сообщений, по которым
+    # модель ничего внятного не вернула (их потом разбираем по одному)
+    metrics.inc("classifier.llm_calls")
+    try:
+        # массив JSON, а не строки «[i] текст»: переносы строк внутри сообщений не путают границы
+        payload = json.dumps(messages, ensure_ascii=False)
+        raw_text = await _chat_completion(_SYSTEM_PROMPT + _BATCH_PROMPT, payload, user_id=user_id)
+        logger.info(f"Ответ Gemini на пакетную классификацию ({len(messages)} сообщ.): {raw_text}")
+
+        match = re.search(r"```(?:json)?\s*(\{.*\})\s*```", raw_text, re.DOTALL)
+        parsed = json.loads(match.group(1) if match else raw_text.strip())
+        if not isinstance(parsed, dict):
+            return [None] * len(messages)
+        return [v if isinstance(v := parsed.get(str(i)), list) else None for i in range(len(messages))]
+    except Exception as e:
+        logger.error(f"Ошибка пакетной классификации: {e}")
+        return [None] * len(messages)
+
+
+class ClassificationBatcher:
+    # копит задания на классификацию (от одного или разных пользователей) в течение
+    # короткого окна и отправляет их модели одним запросом (JSON-массивом сообщений)
+
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max_size
+        self._jobs: list[tuple[str, int | None, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def classify(self, message: str, user_id: int | None = None) -> list[dict] | None:
+        if self.window <= 0:
+            return await llm_extract_items(message, user_id)
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._jobs.append((message, user_id, fut))
+        if len(self._jobs) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await fut
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        jobs, self._jobs = self._jobs, []
+        if jobs:
+            task = asyncio.ensure_future(self._process(jobs))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, jobs: list[tuple[str, int | None, asyncio.Future]]) -> None:
+        messages = [m for m, _, _ in jobs]
+        users = {uid for _, uid, _ in jobs}
+        results: list[list[dict] | None] = [None] * len(jobs)
+        try:
+            if len(jobs) > 1:
+                metrics.inc("classifier.batches")
+                metrics.inc("classifier.batched_messages", len(jobs))
+                results = await llm_extract_batch(messages, users.pop() if len(users) == 1 else None)
+
+            # что пакет не разобрал (или сообщение было одно) — отправляем по отдельности
+            retry = [i for i, r in enumerate(results) if r is None]
+            if len(jobs) > 1 and retry:
+                metrics.inc("classifier.batch_fallbacks", len(retry))
+            singles = await asyncio.gather(*(llm_extract_items(jobs[i][0], jobs[i][1]) for i in retry))
+            for i, items in zip(retry, singles):
+                results[i] = items
+        except Exception as e:
+            logger.exception(f"Ошибка при обработке пакета классификации: {e}")
+        for (_, _, fut), items in zip(jobs, results):
+            if not fut.done():
+                fut.set_result(items)
+
+
+_batcher = ClassificationBatcher(CLASSIFIER_BATCH_WINDOW_SEC, CLASSIFIER_BATCH_MAX_SIZE)
+
+
+async def extract_financial_items(message: str, user_id: int | None = None) -> list[dict]:
+    decision = gate(message)
+    metrics.inc(f"classifier.{decision}")
+    if decision == GATE_SKIP:
+        return []
+    if decision == GATE_LOCAL:
+        items = parse_simple(message)
+        if items:
+            return items
+        metrics.inc("classifier.local_fallback")
+
+    # повторяющиеся формулировки берём из кэша, не обращаясь к модели
+    cached = await classifier_cache.get(PROMPT_VERSION, message)
+    if cached is not None:
+        metrics.inc("classifier.cache_hit")
+        return cached
+    metrics.inc("classifier.cache_miss")
+
+    # сообщения, пришедшие почти одновременно, уходят модели одним пакетом
+    items = await _batcher.classify(message, user_id)
+    if items is None:
+        return []
+    await classifier_cache.put(PROMPT_VERSION, message, items)
+    return items
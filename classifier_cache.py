@@ -0,0 +1,121 @@
+﻿# classifier_cache.py - постоянный кэш ответов классификатора операций (SQLite)
+# Ключ — хэш версии промпта и нормализованного текста сообщения: одинаковые
+# «обед 500» / «такси 300 руб» второй раз к модели не идут, а при изменении промпта
+# старые ответы просто перестают находиться. Размер кэша ограничен суммарным объёмом
+# сохранённых ответов; при переполнении вытесняются давно не использованные записи.
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import metrics
+from config import CLASSIFIER_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+_DB_PATH = config.LOG_DIR / "classifier_cache.sqlite3"
+# все обращения к базе идут в одном потоке: соединение SQLite не делим между потоками
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="classifier-cache")
+_conn: sqlite3.Connection | None = None
+_total_size = 0     # суммарный размер ответов в базе, байт (только в потоке _executor)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key     TEXT PRIMARY KEY,
+    items   TEXT NOT NULL,      -- JSON-массив операций
+    size    INTEGER NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_cache_used_at ON cache(used_at);
+"""
+
+
+def normalize_message(message: str) -> str:
+    text = message.strip().lower().replace("ё", "е")
+    return re.sub(r"\s+", " ", text).strip(" .,!;:«»\"'")
+
+
+def _key(prompt_version: str, message: str) -> str:
+    return hashlib.sha256(f"{prompt_version}\n{normalize_message(message)}".encode()).hexdigest()
+
+
+def _db() -> sqlite3.Connection:
+    global _conn, _total_size
+    if _conn is None:
+        _conn = sqlite3.connect(_DB_PATH)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.executescript(_SCHEMA)
+        _total_size = _conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+    return _conn
+
+
+def _get(key: str) -> list[dict] | None:
+    conn = _db()
+    row = conn.execute("SELECT items FROM cache WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    with conn:
+        conn.execute("UPDATE cache SET used_at = ? WHERE key = ?", (time.time(), key))
+    return json.loads(row[0])
+
+
+def _put(key: str, items: list[dict]) -> None:
+    global _total_size
+    conn = _db()
+    data = json.dumps(items, ensure_ascii=False)
+    size = len(data.encode()) + len(key)
+    with conn:
+        old = conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, items, size, used_at) VALUES (?, ?, ?, ?)",
+            (key, data, size, time.time())
+        )
+    _total_size += size - (old[0] if old else 0)
+    if _total_size > CLASSIFIER_CACHE_MAX_BYTES:
+        _evict(conn)
+    metrics.set_gauge("classifier.cache_bytes", _total_size)
+
+
+def _evict(conn: sqlite3.Connection) -> None:
+    # вытесняем самые давно использованные записи, пока не освободим ~10% объёма
+    global _total_size
+    target = CLASSIFIER_CACHE_MAX_BYTES * 0.9
+    with conn:
+        while _total_size > target:
+            rows = conn.execute("SELECT key, size FROM cache ORDER BY used_at LIMIT 500").fetchall()
+            if not rows:
+                _total_size = 0
+                break
+            for key, size in rows:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                _total_size -= size
+                if _total_size <= target:
+                    break
+    logger.info(f"[classifier_cache] Кэш классификатора ужат до {_total_size} байт")
+
+
+async def _run(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+
+# === Интерфейс для классификатора ===
+
+async def get(prompt_version: str, message: str) -> list[dict] | None:
+    # сохранённый ответ классификатора или None, если такого сообщения ещё не было
+    try:
+        return await _run(_get, _key(prompt_version, message))
+    except Exception as e:
+        logger.warning(f"[classifier_cache] Ошибка чтения кэша: {e}")
+        return None
+
+
+async def put(prompt_version: str, message: str, items: list[dict]) -> None:
+    try:
+        await _run(_put, _key(prompt_version, message), items)
+    except Exception as e:
+        logger.warning(f"[classifier_cache] Ошибка записи в кэш: {e}")
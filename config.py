@@ -37,6 +37,14 @@ try:
 	LOG_DIR = Path(_cfg.get("LOG_DIR", "logs"))
 	LOG_DIR.mkdir(parents=True, exist_ok=True)
 
+	# администраторы бота (доступ к /stats); пусто — команда недоступна никому
+	ADMIN_IDS               = set(_cfg.get("ADMIN_IDS", []))
+
+	# режим webhook: публичный адрес (если задан — регистрируется в Telegram при запуске)
+	# и секрет, который Telegram присылает в заголовке каждого запроса
+	WEBHOOK_URL             = _cfg.get("WEBHOOK_URL", "")
+	WEBHOOK_SECRET          = _cfg.get("WEBHOOK_SECRET", "")
+
 except Exception as e:
     logger.error(f"Не удалось загрузить конфиг из {CONFIG_JSON_PATH}: {e}")
     sys.exit(1)
@@ -67,3 +75,104 @@ CURRENCY_MAP = {
 
 # глубина вложенного автопоиска в интернете
 MAX_SEARCH_DEPTH = 5
+
+# ограничения на обращения к Gemini
+LLM_MAX_CONCURRENCY      = 16   # одновременных вызовов модели на весь бот
+LLM_PER_USER_CONCURRENCY = 2    # одновременных вызовов модели от одного пользователя
+LLM_TIMEOUT_SEC          = 60   # таймаут одного вызова модели, секунд
+
+# выбор между GenAI и Vertex AI: статистика, отключение сбойного backend'а, страхующие запросы
+LLM_STATS_WINDOW         = 100  # по скольким последним вызовам считать задержки и долю ошибок
+LLM_BREAKER_FAILURES     = 5    # ошибок подряд, после которых backend временно отключается
+LLM_BREAKER_COOLDOWN_SEC = 30   # на сколько секунд отключать сбойный backend
+LLM_HEDGE_ENABLED        = True # дублировать запрос на другой backend, если основной медленнее p95
+LLM_HEDGE_MIN_SAMPLES    = 20   # сколько замеров нужно, чтобы p95 считался надёжным
+
+# бюджет промпта: старые реплики вытесняются, роль модели сохраняется всегда
+PROMPT_TOKEN_BUDGET    = 30000  # примерный предел токенов на один промпт
+PROMPT_CHARS_PER_TOKEN = 3      # оценка символов на токен (с запасом для кириллицы)
+
+# сворачивание старой части диалога в резюме
+SUMMARY_THRESHOLD_TURNS = 60    # после скольких реплик в памяти запускать сворачивание
+SUMMARY_KEEP_TURNS      = 20    # сколько последних реплик оставлять дословно
+
+# контексты пользователей в памяти: лишние и давно молчащие выгружаются на диск
+SESSION_MAX_USERS          = 5000     # сколько контекстов держать в памяти одновременно
+SESSION_IDLE_SEC           = 30 * 60  # контекст молчащего столько секунд пользователя выгружается
+SESSION_MEMORY_LIMIT_MB    = 256      # предел примерного объёма всех контекстов
+SESSION_SWEEP_INTERVAL_SEC = 60       # как часто проверять простой и срок подтверждений
+PENDING_TTL_SEC            = 15 * 60  # сколько ждать нажатия «Да/Нет» по найденным операциям
+
+# склейка серии сообщений пользователя в один ход (см. inbox.py)
+MESSAGE_DEBOUNCE_SEC     = 1.2    # пауза, после которой серия считается законченной (продлевается каждым сообщением)
+MESSAGE_DEBOUNCE_MAX_SEC = 3.0    # дольше этого серию не ждём, даже если сообщения идут
+
+# отложенная пакетная запись в Google Sheets
+SHEETS_FLUSH_INTERVAL_SEC = 2.0 # как часто сбрасывать накопленные строки в таблицу
+SHEETS_FLUSH_MAX_ROWS     = 200 # сбрасывать раньше, если накопилось столько строк
+SHEETS_MAX_RETRIES        = 5   # попыток записи при 429/5xx (с экспоненциальной паузой)
+SHEETS_DEAD_LETTER_AFTER  = 8   # после стольких неудачных сбросов строки уходят в файл отказов
+SHEETS_BACKOFF_MAX_SEC    = 600 # предел паузы между сбросами для строк, которые не удалось записать
+SHEETS_STOP_TIMEOUT_SEC   = 30  # сколько ждать завершения текущей записи при остановке
+
+# локальное зеркало операций: как часто сверять его с Google Sheets
+LEDGER_RECONCILE_INTERVAL_SEC = 6 * 60 * 60
+LEDGER_SYNC_WAIT_SEC          = 10  # сколько ждать записи строк пользователя в таблицу перед первой сверкой
+
+# отрисовка диаграмм
+CHART_WORKERS    = 2    # рабочих процессов для matplotlib
+CHART_CACHE_SIZE = 256  # сколько готовых PNG держать в кэше
+
+# интернет-поиск: кэш результатов DuckDuckGo
+SEARCH_CACHE_SIZE       = 1000      # запросов в кэше (вытесняются самые давние)
+SEARCH_TTL_SEC          = 60 * 60   # срок жизни обычного результата
+SEARCH_TTL_VOLATILE_SEC = 5 * 60    # срок жизни для курсов, котировок, новостей
+SEARCH_MAX_CONCURRENCY  = 4         # одновременных запросов к DuckDuckGo
+
+# поисковый этап: несколько запросов за ход модели, загрузка страниц и сборка контекста
+SEARCH_MAX_QUERIES           = 3            # запросов в одной строке SEARCH: (через «|»)
+SEARCH_FETCH_PAGES           = 2            # сколько первых страниц каждого запроса загружать
+SEARCH_FETCH_TIMEOUT_SEC     = 8            # таймаут загрузки страницы
+SEARCH_FETCH_MAX_CONNECTIONS = 20           # соединений в пуле HTTP-клиента
+SEARCH_FETCH_PER_HOST        = 2            # одновременных загрузок с одного сайта
+SEARCH_FETCH_MAX_BYTES       = 1024 * 1024  # дальше страница не дочитывается
+SEARCH_EXTRACT_WORKERS       = 2            # процессов для извлечения текста из HTML
+SEARCH_PAGE_MAX_CHARS        = 2500         # текста с одной страницы в контексте
+SEARCH_CONTEXT_MAX_CHARS     = 9000         # предел всего контекста поиска для модели
+
+# хранилище результатов поиска (в истории диалога — только ссылка на них)
+SEARCH_STORE_TTL_SEC     = 24 * 60 * 60  # сколько хранить результаты
+SEARCH_STORE_MAX_SOURCES = 5000          # источников в памяти (вытесняются самые давние)
+SEARCH_STORE_MAX_CYCLES  = 2000          # поисковых этапов в памяти
+SEARCH_FOLLOWUP_TURNS    = 4             # в скольких последних репликах искать ссылку для уточняющего вопроса
+
+
+# быстрые ответы без модели: таблица курсов валют (ЦБ РФ)
+RATES_REFRESH_SEC = 60 * 60       # как часто обновлять курсы в фоне
+RATES_MAX_AGE_SEC = 12 * 60 * 60  # старше этого курсы не отдаются, вопрос уходит в модель
+
+# классификатор операций: кэш ответов (SQLite в LOG_DIR) и пакетные запросы к модели
+CLASSIFIER_CACHE_MAX_BYTES  = 8 * 1024 * 1024  # предел суммарного объёма сохранённых ответов
+CLASSIFIER_BATCH_WINDOW_SEC = 0.3              # окно сбора сообщений в один запрос (0 — без пакетов)
+CLASSIFIER_BATCH_MAX_SIZE   = 20               # сообщений в одном пакетном запросе
+
+# потоковый вывод ответа модели в Telegram
+STREAM_EDIT_INTERVAL_SEC = 1.0     # не чаще одной правки сообщения в секунду
+TELEGRAM_MAX_MESSAGE_LEN = 4096    # предел длины одного сообщения Telegram
+
+# исходящие сообщения (telegram_sender.py): лимиты Telegram на отправку и правки
+TELEGRAM_GLOBAL_RATE  = 25     # сообщений в секунду на весь бот (предел Telegram — около 30)
+TELEGRAM_CHAT_RATE    = 1.0    # сообщений в секунду в один чат
+TELEGRAM_CHAT_BURST   = 3      # сколько сообщений подряд можно отправить в чат без паузы
+TELEGRAM_SEND_RETRIES = 3      # повторов после RetryAfter / TimedOut
+
+# режим webhook: локальный HTTP-сервер раздаёт апдейты рабочим процессам по user_id
+WEBHOOK_HOST              = "0.0.0.0"
+WEBHOOK_PORT              = 8443
+WEBHOOK_PATH              = "/telegram"
+WEBHOOK_WORKERS           = os.cpu_count() or 1  # рабочих процессов с ботом
+WEBHOOK_QUEUE_SIZE        = 1000                 # апдейтов в очереди одного процесса (дальше — 503)
+WEBHOOK_DRAIN_TIMEOUT_SEC = 30                   # сколько ждать доработки апдейтов при остановке
+# номер текущего рабочего процесса и их общее число (выставляет webhook.py в каждом процессе)
+WORKER_ID    = 0
+WORKER_COUNT = 1
\ No newline at end of file
@@ -0,0 +1,179 @@
+﻿# conversation.py - контекст диалога пользователя и сборка промпта для Gemini
+import sys
+from collections import deque
+from itertools import islice
+
+from config import PROMPT_TOKEN_BUDGET, PROMPT_CHARS_PER_TOKEN
+
+# служебная роль записи с резюме старой части диалога
+SUMMARY_ROLE = "summary"
+
+_TURN_OVERHEAD = 120    # примерный размер объекта реплики и ссылок на него, байт
+
+
+# грубая оценка числа токенов: точный токенайзер Gemini не нужен,
+# достаточно держать промпт примерно в пределах бюджета
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // PROMPT_CHARS_PER_TOKEN)
+
+
+class Turn:
+    # одна реплика в памяти: роль интернирована (одна строка на всех пользователей),
+    # части хранятся кортежем; на диск уходит прежний формат {"role", "parts"}
+    __slots__ = ("role", "parts")
+
+    def __init__(self, role: str, parts: tuple[str, ...]):
+        self.role = sys.intern(role)
+        self.parts = parts
+
+    def to_record(self) -> dict:
+        return {"role": self.role, "parts": list(self.parts)}
+
+    def size(self) -> int:
+        return _TURN_OVERHEAD + sum(sys.getsizeof(part) for part in self.parts)
+
+
+class ConversationContext:
+    # История пользователя + промпт, который собирается инкрементально.
+    # history      — кольцевой буфер реплик Turn (без резюме), не длиннее max_history;
+    # summary      — резюме реплик, свёрнутых из истории моделью;
+    # _unsaved     — сколько последних реплик ещё не записано на диск;
+    # _window      — части промпта (после роли и резюме), которые укладываются в бюджет токенов;
+    # _prompt      — готовая строка промпта, дописывается при каждом новом сообщении;
+    # _history_bytes — примерный объём реплик в памяти (для предела SessionStore).
+    # Ролевая инструкция и резюме закреплены и никогда не вытесняются из промпта.
+
+    def __init__(self, role_prompt: str, history: list[dict] | None = None,
+                 token_budget: int = PROMPT_TOKEN_BUDGET, max_history: int | None = None):
+        self.role_prompt = role_prompt
+        self.token_budget = token_budget
+        self.max_history = max_history
+        self.history: deque[Turn] = deque(maxlen=max_history or None)
+        self._history_bytes = 0
+        self.summary: str | None = None
+        self._summarizing = False
+        self._summary_dirty = False
+        self._unsaved = 0
+        self._window: deque[tuple[str, int, Turn]] = deque()   # (часть, токены, сообщение)
+        self._window_tokens = 0
+
+        # если в сохранённой истории есть резюме — берём последнее и реплики после него
+        history = history or []
+        start = 0
+        for i, msg in enumerate(history):
+            if msg.get("role") == SUMMARY_ROLE:
+                self.summary = "".join(msg.get("parts", []))
+                start = i + 1
+        self._head = self._build_head()
+        self._head_tokens = estimate_tokens(self._head)
+        self._prompt = self._head
+
+        for msg in history[start:]:
+            self.append(msg.get("role", "user"), *msg.get("parts", []))
+        self._unsaved = 0   # всё загруженное уже лежит на диске
+
+    def _build_head(self) -> str:
+        if not self.summary:
+            return self.role_prompt
+        return f"{self.role_prompt}\nКраткое содержание предыдущего диалога: {self.summary}"
+
+    @property
+    def tokens(self) -> int:
+        # примерный размер текущего промпта в токенах
+        return self._head_tokens + self._window_tokens
+
+    def memory_size(self) -> int:
+        # примерный объём контекста в памяти, байт: реплики + собранный промпт
+        return self._history_bytes + sys.getsizeof(self._prompt)
+
+    def drain_unsaved(self) -> list[dict]:
+        # записи, которые нужно дописать на диск с прошлого сохранения.
+        # Новое резюме идёт первым: keep — сколько уже сохранённых реплик перед ним остаются в силе.
+        records = []
+        if self._summary_dirty:
+            records.append({"role": SUMMARY_ROLE, "parts": [self.summary],
+                            "keep": len(self.history) - self._unsaved})
+            self._summary_dirty = False
+        if self._unsaved:
+            start = len(self.history) - self._unsaved
+            records.extend(msg.to_record() for msg in islice(self.history, start, None))
+            self._unsaved = 0
+        return records
+
+    def append(self, role: str, *parts: str) -> None:
+        # добавляет сообщение в историю и дописывает его части в промпт
+        # (переполненный буфер сам выталкивает самую старую реплику — без копирования списка)
+        msg = Turn(role, parts)
+        dropped = ()
+        if self.history.maxlen and len(self.history) == self.history.maxlen:
+            dropped = (self.history[0],)
+            self._history_bytes -= dropped[0].size()
+        self.history.append(msg)
+        self._history_bytes += msg.size()
+        self._unsaved = min(self._unsaved + 1, len(self.history))
+        self._add_parts(msg)
+        self._trim(dropped)
+
+    def _add_parts(self, msg: Turn) -> None:
+        for part in msg.parts:
+            tokens = estimate_tokens(part)
+            self._window.append((part, tokens, msg))
+            self._window_tokens += tokens
+            self._prompt += "\n" + part
+
+    def _trim(self, dropped=()) -> None:
+        # вытесняем из промпта реплики, ушедшие из истории, и самые старые части,
+        # пока промпт не уложится в бюджет (последнюю часть оставляем всегда,
+        # иначе модели нечего будет ответить)
+        dropped_ids = {id(msg) for msg in dropped}
+        cut = 0
+        while self._window and (
+                id(self._window[0][2]) in dropped_ids
+                or (self.tokens > self.token_budget and len(self._window) > 1)):
+            part, tokens, _ = self._window.popleft()
+            self._window_tokens -= tokens
+            cut += len(part) + 1
+        if cut:
+            head = len(self._head)
+            self._prompt = self._prompt[:head] + self._prompt[head + cut:]
+
+    def prompt(self) -> str:
+        return self._prompt
+
+    # === Сворачивание старых реплик в резюме ===
+
+    def needs_summary(self, threshold: int) -> bool:
+        return not self._summarizing and len(self.history) > threshold
+
+    def start_summary(self, keep: int) -> list[Turn] | None:
+        # помечает начало сворачивания и возвращает реплики, которые надо свернуть
+        # (последние keep реплик остаются дословно). None — сворачивать нечего.
+        if self._summarizing or len(self.history) <= keep:
+            return None
+        self._summarizing = True
+        return list(islice(self.history, len(self.history) - keep))
+
+    def apply_summary(self, summary: str, folded: list[Turn]) -> None:
+        # заменяет свёрнутые реплики резюме. Пока модель писала резюме, в историю могли
+        # добавиться новые реплики, поэтому удаляем именно свёрнутые записи, а не срез по индексу.
+        folded_ids = {id(msg) for msg in folded}
+        self.history = deque((msg for msg in self.history if id(msg) not in folded_ids),
+                             maxlen=self.history.maxlen)
+        self._history_bytes = sum(msg.size() for msg in self.history)
+        self._unsaved = min(self._unsaved, len(self.history))
+        self.summary = summary
+        self._summary_dirty = True
+        self._rebuild()
+
+    def finish_summary(self) -> None:
+        self._summarizing = False
+
+    def _rebuild(self) -> None:
+        self._head = self._build_head()
+        self._head_tokens = estimate_tokens(self._head)
+        self._prompt = self._head
+        self._window.clear()
+        self._window_tokens = 0
+        for msg in self.history:
+            self._add_parts(msg)
+        self._trim()
@@ -0,0 +1,89 @@
+﻿# exporter.py - выгрузка операций пользователя в xlsx / csv / parquet
+# Строки читаются из ledger порциями и сразу пишутся в буфер в памяти: на диске
+# ничего не остаётся, а память занимает только сам итоговый файл.
+import csv
+import io
+
+from google_sheet_client import SHEET_HEADERS
+
+EXPORT_FORMATS = ("xlsx", "csv", "parquet")
+_PARQUET_BATCH = 5000
+
+
+class ExportError(Exception):
+    pass
+
+
+def _write_csv(rows, buf: io.BytesIO) -> int:
+    # utf-8-sig — чтобы Excel сразу открыл кириллицу
+    text = io.TextIOWrapper(buf, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text, delimiter=";")
+    writer.writerow(SHEET_HEADERS)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    text.flush()
+    text.detach()   # буфер нужен дальше, закрывать его вместе с обёрткой нельзя
+    return count
+
+
+def _write_xlsx(rows, buf: io.BytesIO) -> int:
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)   # потоковый режим: строки не копятся в памяти как объекты ячеек
+    ws = wb.create_sheet("Операции")
+    ws.append(SHEET_HEADERS)
+    count = 0
+    for row in rows:
+        ws.append(row)
+        count += 1
+    wb.save(buf)
+    return count
+
+
+def _write_parquet(rows, buf: io.BytesIO) -> int:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ExportError("Выгрузка в Parquet недоступна: не установлен pyarrow.")
+
+    schema = pa.schema([(name, pa.string()) for name in SHEET_HEADERS])
+    count = 0
+    # пишем в буфер pyarrow: закрытие ParquetWriter закрывает и поток, в который он писал
+    sink = pa.BufferOutputStream()
+    with pq.ParquetWriter(sink, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= _PARQUET_BATCH:
+                writer.write_batch(_to_batch(pa, schema, batch))
+                count += len(batch)
+                batch = []
+        if batch or not count:
+            writer.write_batch(_to_batch(pa, schema, batch))
+            count += len(batch)
+    buf.write(sink.getvalue().to_pybytes())
+    return count
+
+
+def _to_batch(pa, schema, rows: list[list]):
+    columns = [[None if row[i] is None else str(row[i]) for row in rows] for i in range(len(SHEET_HEADERS))]
+    return pa.RecordBatch.from_arrays([pa.array(col, pa.string()) for col in columns], schema=schema)
+
+
+_WRITERS = {
+    "xlsx": _write_xlsx,
+    "csv": _write_csv,
+    "parquet": _write_parquet,
+}
+
+
+def build_export(rows, fmt: str) -> tuple[bytes, int]:
+    # пишет строки rows (итератор) в формат fmt; возвращает содержимое файла и число строк.
+    # Блокирующая функция — вызывать в рабочем потоке.
+    if fmt not in _WRITERS:
+        raise ExportError(f"Неизвестный формат выгрузки: {fmt}. Доступны: {', '.join(EXPORT_FORMATS)}.")
+    buf = io.BytesIO()
+    count = _WRITERS[fmt](rows, buf)
+    return buf.getvalue(), count
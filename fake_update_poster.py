@@ -0,0 +1,79 @@
+﻿# fake_update_poster.py - локальная проверка режима webhook: шлёт на сервер поддельные апдейты Telegram
+# Запуск (бот: python main.py --webhook --no-register):
+#   python fake_update_poster.py --users 50 --messages 20 --concurrency 16
+# Апдейты устроены как настоящие (message от пользователя в личном чате), поэтому
+# проходят весь путь до обработчиков; ответы бота уйдут в Telegram API с реальным токеном.
+import argparse
+import json
+import random
+import statistics
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from config import WEBHOOK_PATH, WEBHOOK_PORT
+
+_TEXTS = ["привет", "кофе 300 руб", "какое сегодня число?", "курс доллара", "такси 450 руб",
+          "как лучше откладывать на отпуск?", "обед 500"]
+
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"Test{user_id}", "username": f"test_{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+def post(url: str, update: dict) -> tuple[int, float]:
+    headers = {"Content-Type": "application/json"}
+    if config.WEBHOOK_SECRET:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = config.WEBHOOK_SECRET
+    req = urllib.request.Request(url, data=json.dumps(update).encode(), headers=headers)
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            status = resp.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Поддельные апдейты Telegram для режима webhook")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    parser.add_argument("--users", type=int, default=10, help="сколько разных пользователей")
+    parser.add_argument("--messages", type=int, default=5, help="сообщений от каждого пользователя")
+    parser.add_argument("--concurrency", type=int, default=8, help="одновременных запросов")
+    parser.add_argument("--first-user-id", type=int, default=10_000_000)
+    args = parser.parse_args()
+
+    updates = [
+        make_update(n, args.first_user_id + n % args.users, random.choice(_TEXTS))
+        for n in range(1, args.users * args.messages + 1)
+    ]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda u: post(args.url, u), updates))
+    elapsed = time.perf_counter() - started
+
+    statuses: dict[int, int] = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    latencies = sorted(latency for _, latency in results)
+    print(f"Отправлено {len(updates)} апдейтов за {elapsed:.2f} с ({len(updates) / elapsed:.0f} в секунду)")
+    print(f"Коды ответа: {statuses}")
+    print(f"Задержка приёма: медиана {statistics.median(latencies) * 1000:.1f} мс, "
+          f"p95 {latencies[int(0.95 * (len(latencies) - 1))] * 1000:.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
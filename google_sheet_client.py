@@ -1,52 +1,376 @@
 ﻿#google_sheet_client.py - файл для сохранения личных данных в Excel
+import asyncio
 import json
+import logging
+import os
+import threading
+import time
+import uuid
 from datetime import datetime
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from pathlib import Path
 import config
+from config import (
+    SHEETS_FLUSH_INTERVAL_SEC, SHEETS_FLUSH_MAX_ROWS, SHEETS_MAX_RETRIES,
+    SHEETS_DEAD_LETTER_AFTER, SHEETS_BACKOFF_MAX_SEC, SHEETS_STOP_TIMEOUT_SEC
+)
+
+logger = logging.getLogger(__name__)
+
+_SCOPE = ["https://spreadsheets.google.com/feeds",
+          "https://www.googleapis.com/auth/drive"]
+
+# Общие на весь процесс авторизованный клиент, таблица и листы пользователей:
+# авторизация и поиск листа выполняются один раз, а не перед каждой записью.
+# Токен доступа обновляет сама авторизованная сессия gspread, отдельно его обновлять не нужно.
+# gspread и oauth2client импортируются при первом обращении к таблице, а не при запуске бота.
+_lock = threading.RLock()
+_client = None
+_spreadsheet = None
+_worksheets: dict = {}      # название листа -> gspread.Worksheet
+
+
+def _get_client():
+    global _client
+    with _lock:
+        if _client is None:
+            import gspread
+            from oauth2client.service_account import ServiceAccountCredentials
+            creds = ServiceAccountCredentials.from_json_keyfile_name(
+                config.GOOGLE_CREDENTIALS_PATH, _SCOPE)
+            _client = gspread.authorize(creds)
+        return _client
+
+
+def get_spreadsheet():
+    # возвращает закэшированную таблицу config.SHEET_NAME
+    global _spreadsheet
+    with _lock:
+        client = _get_client()
+        if _spreadsheet is None:
+            _spreadsheet = client.open(config.SHEET_NAME)
+        return _spreadsheet
+
+
+def invalidate_cache(title: str | None = None, reauth: bool = False):
+    # сбрасывает закэшированный лист title (или все листы и таблицу),
+    # при reauth — ещё и клиента, чтобы авторизоваться заново
+    global _client, _spreadsheet
+    with _lock:
+        if title is not None:
+            _worksheets.pop(title, None)
+            return
+        _worksheets.clear()
+        _spreadsheet = None
+        if reauth:
+            _client = None
+
+
+ERRORS_SHEET = "ошибки"
+SHEET_HEADERS = ["User ID", "Username", "Дата и время",
+                 "Категория", "Сумма", "Валюта", "Источник"]
+
+
+def _sheet_title(user_id: int, errors: bool) -> str:
+    return ERRORS_SHEET if errors else f"user_{user_id}"
+
 
 # открывает или создаём лист
 # Если errors = False — возвращает / создаёт лист user_{user_id}.
 # Если errors = True  — возвращает / создаёт лист "ошибки".
 def get_or_create_sheet_for_user(user_id: int, errors: bool = False):
-    scope = ["https://spreadsheets.google.com/feeds",
-             "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_name(
-        config.GOOGLE_CREDENTIALS_PATH, scope)
-    client = gspread.authorize(creds)
-    spreadsheet = client.open(config.SHEET_NAME)
-    title = "ошибки" if errors else f"user_{user_id}"
+    return _get_or_create_sheet(_sheet_title(user_id, errors))
+
+
+def _get_or_create_sheet(title: str):
+    import gspread
+    errors = title == ERRORS_SHEET
+    with _lock:
+        ws = _worksheets.get(title)
+        if ws is not None:
+            return ws
+        spreadsheet = get_spreadsheet()
+        try:
+            ws = spreadsheet.worksheet(title)
+        except gspread.exceptions.WorksheetNotFound:
+            ws = spreadsheet.add_worksheet(title=title, rows="1000", cols="10")
+            if errors:
+                ws.append_row(["User ID", "Username", "Дата и время", "Оригинал", "Сырые данные"])
+        _worksheets[title] = ws
+        return ws
+
+
+def _sheet_errors() -> tuple:
+    # ошибки API и сети, после которых запись имеет смысл повторить
+    import gspread
+    import requests
+    return gspread.exceptions.APIError, requests.exceptions.RequestException
+
+
+def _api_status(e: Exception) -> int | None:
+    return getattr(getattr(e, "response", None), "status_code", None)
+
+
+def _with_sheet(title: str, action):
+    # выполняет action(ws) на закэшированном листе. Если лист удалили/переименовали
+    # или истекла авторизация — сбрасывает кэш и повторяет один раз.
+    import gspread
     try:
-        ws = spreadsheet.worksheet(title)
-    except gspread.exceptions.WorksheetNotFound:
-        ws = spreadsheet.add_worksheet(title=title, rows="1000", cols="10")
-        if errors:
-            ws.append_row(["User ID", "Username", "Дата и время", "Оригинал", "Сырые данные"])
-    return ws
-
-def write_valid_data(user_id: int, username: str, rows: list[list[str]]):
-    # записывает готовые строки rows в лист пользователя
-    ws = get_or_create_sheet_for_user(user_id, errors=False)
-    ws.append_rows(rows)
-
-def log_error(user_id: int, username: str, original_msg: str, items: list[dict]):
-    # записывает в лист "ошибки" нераспознанное сообщение + сырые items
-    ws = get_or_create_sheet_for_user(user_id, errors=True)
-    ws.append_row([
+        return action(_get_or_create_sheet(title))
+    except gspread.exceptions.APIError as e:
+        status = _api_status(e)
+        if status == 429 or (status or 0) >= 500:
+            raise   # перегрузка/сбой на стороне Google — кэш тут ни при чём
+        logger.warning(f"[google_sheet_client] Ошибка API ({status}), сбрасываем кэш листа: {e}")
+        if status == 401:
+            invalidate_cache(reauth=True)
+        else:
+            invalidate_cache(title)
+            if status == 404:
+                invalidate_cache()
+        return action(_get_or_create_sheet(title))
+
+
+def get_user_rows(user_id: int) -> list[list[str]]:
+    # все строки операций с листа пользователя без строки заголовков
+    # (один запрос к API при тёплом кэше)
+    values = _with_sheet(_sheet_title(user_id, False), lambda ws: ws.get_all_values())
+    return [row for row in values if row and row[0] != SHEET_HEADERS[0]]
+
+
+# === Отложенная пакетная запись (write-behind) ===
+# Строки сначала надёжно дописываются в локальный журнал (spill-файл), затем копятся
+# в памяти по листам и уходят одним append_rows на лист раз в SHEETS_FLUSH_INTERVAL_SEC
+# (или раньше, если набралось SHEETS_FLUSH_MAX_ROWS строк). Журнал переживает падение
+# процесса: при старте незаписанные строки подхватываются заново.
+# Запись, которую не удалось отправить, повторяется отдельно от остальных с растущей
+# паузой между сбросами; после SHEETS_DEAD_LETTER_AFTER неудач она переносится в файл
+# отказов (dead_path) и больше не блокирует очередь.
+class SheetWriteQueue:
+
+    def __init__(self, spill_path: Path, dead_path: Path):
+        self._spill_path = spill_path
+        self._dead_path = dead_path
+        self._spill_lock = threading.Lock()
+        self._pending: dict[str, list[tuple[str, list]]] = {}   # лист -> [(id записи, строки)]
+        self._pending_rows = 0
+        self._failures: dict[str, tuple[int, float]] = {}   # id записи -> (неудач, когда повторить)
+        self._stopping = False
+        self._spilling = 0      # записей, которые прямо сейчас дописываются в журнал
+        self._inflight: set[str] = set()    # листы, в которые идёт запись прямо сейчас
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    # --- журнал ---
+
+    def _spill_write(self, entries: list[dict], path: Path | None = None) -> None:
+        data = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries)
+        with self._spill_lock:
+            with open(path or self._spill_path, "a", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _spill_truncate(self) -> None:
+        with self._spill_lock:
+            if self._spill_path.exists():
+                self._spill_path.unlink()
+
+    def _spill_replay(self) -> list[dict]:
+        # незаписанные в таблицу строки из журнала (записи без отметки done)
+        if not self._spill_path.exists():
+            return []
+        entries, done = [], set()
+        with open(self._spill_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    e = json.loads(line)
+                except ValueError:
+                    continue    # строка, недописанная при падении
+                if "done" in e:
+                    done.update(e["done"])
+                else:
+                    entries.append(e)
+        return [e for e in entries if e["id"] not in done]
+
+    # --- очередь ---
+
+    def _put(self, entry_id: str, title: str, rows: list) -> None:
+        self._pending.setdefault(title, []).append((entry_id, rows))
+        self._pending_rows += len(rows)
+        if self._wakeup and self._pending_rows >= SHEETS_FLUSH_MAX_ROWS:
+            self._wakeup.set()
+
+    async def enqueue(self, title: str, rows: list[list]) -> None:
+        # ставит строки в очередь; возвращает управление, когда они уже записаны в журнал
+        entry_id = uuid.uuid4().hex
+        self._put(entry_id, title, rows)
+        self._spilling += 1
+        try:
+            await asyncio.to_thread(self._spill_write, [{"id": entry_id, "title": title, "rows": rows}])
+        finally:
+            self._spilling -= 1
+
+    def has_pending(self, user_id: int) -> bool:
+        # есть ли строки пользователя, ещё не дошедшие до таблицы
+        title = _sheet_title(user_id, False)
+        return bool(self._pending.get(title)) or title in self._inflight
+
+    async def wait_user(self, user_id: int, timeout: float) -> bool:
+        # просит фоновую задачу сбросить очередь и ждёт, пока строки пользователя дойдут
+        # до таблицы. False — не успели (например, запись отложена после ошибок)
+        if self._task is None:
+            await self.flush()
+            return not self.has_pending(user_id)
+        deadline = time.monotonic() + timeout
+        while self.has_pending(user_id):
+            if time.monotonic() >= deadline:
+                return False
+            self._wakeup.set()
+            await asyncio.sleep(0.1)
+        return True
+
+    def start(self) -> None:
+        for e in self._spill_replay():
+            self._put(e["id"], e["title"], e["rows"])
+        if self._pending_rows:
+            logger.info(f"[google_sheet_client] Из журнала восстановлено строк: {self._pending_rows}")
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        # дописывает всё накопленное перед остановкой бота. Фоновую задачу не отменяем:
+        # отмена посреди append_rows оставила бы записанные строки без отметки done,
+        # и при следующем запуске они ушли бы в таблицу второй раз
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), SHEETS_STOP_TIMEOUT_SEC)
+            except asyncio.TimeoutError:
+                logger.warning("[google_sheet_client] Запись в таблицу не завершилась за "
+                               f"{SHEETS_STOP_TIMEOUT_SEC} с, незаписанные строки остаются в журнале")
+            self._task = None
+        else:
+            await self.flush()
+
+    async def _run(self) -> None:
+        # после остановки (stop) выполняется ещё один, последний сброс
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), SHEETS_FLUSH_INTERVAL_SEC)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("[google_sheet_client] Ошибка фоновой записи в таблицу")
+        await self.flush()  # строки, поставленные в очередь, пока шла последняя запись
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        now = time.monotonic()
+        batches, self._pending, self._pending_rows = self._pending, {}, 0
+        for title, entries in batches.items():
+            # записи, которые ещё ждут повтора после неудачи, остаются в очереди
+            due = []
+            for entry_id, entry_rows in entries:
+                if self._failures.get(entry_id, (0, 0.0))[1] > now:
+                    self._put(entry_id, title, entry_rows)
+                else:
+                    due.append((entry_id, entry_rows))
+            # новые записи листа уходят одним запросом, ранее неудачные — каждая отдельно,
+            # чтобы одна «плохая» запись не мешала остальным
+            fresh = [e for e in due if e[0] not in self._failures]
+            groups = ([fresh] if fresh else []) + [[e] for e in due if e[0] in self._failures]
+            for group in groups:
+                await self._flush_group(title, group)
+        # всё записано — журнал больше не нужен (новые записи попадут уже в новый файл)
+        if not self._pending and not self._spilling:
+            self._spill_truncate()
+
+    async def _flush_group(self, title: str, entries: list[tuple[str, list]]) -> None:
+        rows = [row for _, entry_rows in entries for row in entry_rows]
+        ids = [entry_id for entry_id, _ in entries]
+        self._inflight.add(title)
+        try:
+            ok = await self._append_with_retry(title, rows)
+        finally:
+            self._inflight.discard(title)
+        if ok:
+            for entry_id in ids:
+                self._failures.pop(entry_id, None)
+            await asyncio.to_thread(self._spill_write, [{"done": ids}])
+            return
+
+        dead = []
+        for entry_id, entry_rows in entries:
+            failures = self._failures.get(entry_id, (0, 0.0))[0] + 1
+            if failures >= SHEETS_DEAD_LETTER_AFTER:
+                self._failures.pop(entry_id, None)
+                dead.append({"id": entry_id, "title": title, "rows": entry_rows,
+                             "failed_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+                continue
+            # не получилось — возвращаем в очередь с паузой, строки остаются в журнале
+            backoff = min(SHEETS_FLUSH_INTERVAL_SEC * 2 ** failures, SHEETS_BACKOFF_MAX_SEC)
+            self._failures[entry_id] = (failures, time.monotonic() + backoff)
+            self._put(entry_id, title, entry_rows)
+        if dead:
+            await asyncio.to_thread(self._spill_write, dead, self._dead_path)
+            await asyncio.to_thread(self._spill_write, [{"done": [e["id"] for e in dead]}])
+            logger.error(f"[google_sheet_client] {sum(len(e['rows']) for e in dead)} строк для «{title}» "
+                         f"не удалось записать после {SHEETS_DEAD_LETTER_AFTER} попыток, "
+                         f"они перенесены в {self._dead_path.name}")
+
+    async def _append_with_retry(self, title: str, rows: list) -> bool:
+        delay = 1
+        for attempt in range(1, SHEETS_MAX_RETRIES + 1):
+            try:
+                await asyncio.to_thread(_with_sheet, title, lambda ws: ws.append_rows(rows))
+                return True
+            except _sheet_errors() as e:
+                status = _api_status(e)
+                retryable = status is None or status == 429 or status >= 500
+                logger.warning(f"[google_sheet_client] Не удалось записать {len(rows)} строк в «{title}» "
+                               f"(попытка {attempt}, код {status}): {e}")
+                if not retryable or self._stopping:
+                    break
+                if attempt < SHEETS_MAX_RETRIES:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 60)
+            except Exception as e:
+                logger.error(f"[google_sheet_client] Ошибка записи в «{title}»: {e}")
+                break
+        return False
+
+
+# в режиме webhook у каждого рабочего процесса свой журнал очереди и файл отказов
+_suffix = f"-{config.WORKER_ID}" if config.WORKER_COUNT > 1 else ""
+sheet_writer = SheetWriteQueue(config.LOG_DIR / f"sheets_pending{_suffix}.jsonl",
+                               config.LOG_DIR / f"sheets_dead_letter{_suffix}.jsonl")
+
+
+async def write_valid_data(user_id: int, username: str, rows: list[list[str]]):
+    # ставит готовые строки rows в очередь записи в лист пользователя
+    await sheet_writer.enqueue(_sheet_title(user_id, False), rows)
+
+async def log_error(user_id: int, username: str, original_msg: str, items: list[dict]):
+    # ставит в очередь записи в лист "ошибки" нераспознанное сообщение + сырые items
+    row = [
         str(user_id),
         f"@{username}",
         datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         original_msg,
         json.dumps(items, ensure_ascii=False)
-    ])
+    ]
+    await sheet_writer.enqueue(ERRORS_SHEET, [row])
 
 # вставляет заголовки, если их нет или они не совпадают
 def _ensure_headers(ws):
-    expected = ["User ID", "Username", "Дата и время",
-                "Категория", "Сумма", "Валюта", "Источник"]
     row1 = ws.row_values(1)
-    if row1 != expected:
-        ws.insert_row(expected, index=1)
+    if row1 != SHEET_HEADERS:
+        ws.insert_row(SHEET_HEADERS, index=1)
 
 
 
@@ -0,0 +1,202 @@
+﻿# history_store.py - хранение истории диалогов пользователей (append-only JSONL)
+# Каждая реплика — одна строка JSON в файле LOG_DIR/{user_id}.jsonl. При сохранении
+# дописываются только новые реплики; резюме старой части диалога пишется отдельной
+# записью {"role": "summary", "parts": [...], "keep": K}, где K — сколько реплик перед
+# ней остаются дословно. Весь файловый ввод-вывод идёт в одном фоновом потоке:
+# это не блокирует event loop и сохраняет порядок операций над файлом пользователя.
+import json
+import logging
+import os
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import config
+import search_store
+from conversation import SUMMARY_ROLE
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+_line_counts: dict[int, int] = {}   # user_id -> число строк в файле (чтобы не пересчитывать)
+_TAIL_CHUNK = 64 * 1024
+_SUMMARY_MARK = json.dumps({"role": SUMMARY_ROLE})[1:-1].encode()    # '"role": "summary"'
+# приветствие с текущим временем: в историях старого формата ему всегда предшествует
+# запись с ролевой инструкцией той версии бота, что создала историю
+_GREETING_RE = re.compile(r"Сейчас \d{2}\.\d{2}\.\d{4} \d{2}:\d{2}\.")
+
+
+def _path(user_id: int) -> Path:
+    return config.LOG_DIR / f"{user_id}.jsonl"
+
+
+def _legacy_path(user_id: int) -> Path:
+    # файл старого формата: весь JSON-массив целиком
+    return config.LOG_DIR / f"{user_id}.json"
+
+
+def _log_failure(action: str, user_id: int):
+    def _callback(fut: Future):
+        if fut.exception():
+            logger.error(f"Ошибка при {action} истории {user_id}: {fut.exception()}")
+    return _callback
+
+
+# === Публичный интерфейс (вызывается из event loop, работа уходит в фоновый поток) ===
+
+def append_records(user_id: int, records: list[dict], max_records: int) -> Future | None:
+    # дописывает новые записи в конец файла пользователя
+    if not records:
+        return None
+    # сериализуем сразу: записи в памяти могут измениться раньше, чем до них дойдёт поток
+    data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+    fut = _executor.submit(_append, user_id, data, len(records), max_records)
+    fut.add_done_callback(_log_failure("сохранении", user_id))
+    return fut
+
+
+def load_records(user_id: int, max_records: int) -> Future:
+    # читает хвост файла: последнее резюме с оставленными репликами и всё, что после него
+    return _executor.submit(_load, user_id, max_records)
+
+
+def delete_history(user_id: int) -> Future:
+    fut = _executor.submit(_delete, user_id)
+    fut.add_done_callback(_log_failure("удалении", user_id))
+    return fut
+
+
+# === Работа с файлами (только в потоке _executor) ===
+
+def _append(user_id: int, data: str, count: int, max_records: int) -> None:
+    path = _path(user_id)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    lines = _line_counts.get(user_id)
+    lines = _count_lines(path) if lines is None else lines + count
+    _line_counts[user_id] = lines
+
+    # файл растёт только дописыванием, поэтому изредка ужимаем его
+    if lines > 2 * max_records:
+        _compact(user_id, max_records)
+
+
+def _load(user_id: int, max_records: int) -> list[dict]:
+    path = _path(user_id)
+    if not path.exists() and _legacy_path(user_id).exists():
+        _migrate_legacy(user_id, max_records)
+    if not path.exists():
+        return []
+    return _shrink(_bounded(_resolve(_read_tail(path, max_records)), max_records))
+
+
+def _delete(user_id: int) -> None:
+    _line_counts.pop(user_id, None)
+    for path in (_path(user_id), _legacy_path(user_id)):
+        if path.exists():
+            path.unlink()
+
+
+def _count_lines(path: Path) -> int:
+    with open(path, "rb") as f:
+        return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(_TAIL_CHUNK), b""))
+
+
+def _read_tail(path: Path, max_lines: int) -> list[dict]:
+    # читает файл с конца блоками, пока не наберёт max_lines строк и не встретит резюме
+    # (реплики до резюме всё равно отбросит _resolve). Файл ограничен сжатием, так что
+    # в худшем случае читается не больше ~2 * max_lines строк.
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        buf = b""
+        while pos > 0 and (buf.count(b"\n") <= max_lines or _SUMMARY_MARK not in buf):
+            step = min(_TAIL_CHUNK, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+
+    lines = buf.splitlines()
+    if pos > 0:
+        lines = lines[1:]   # первая строка блока может быть обрезана
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            logger.warning(f"Пропущена повреждённая строка истории в {path.name}")
+    return records
+
+
+def _resolve(records: list[dict]) -> list[dict]:
+    # оставляет последнее резюме, K реплик перед ним и все реплики после него
+    for i in range(len(records) - 1, -1, -1):
+        if records[i].get("role") == SUMMARY_ROLE:
+            keep = records[i].get("keep", 0)
+            summary = {"role": SUMMARY_ROLE, "parts": records[i].get("parts", [])}
+            return [summary] + records[max(0, i - keep):i] + records[i + 1:]
+    return records
+
+
+def _bounded(records: list[dict], max_records: int) -> list[dict]:
+    # не больше max_records реплик; резюме в начале сохраняется всегда
+    if records and records[0].get("role") == SUMMARY_ROLE:
+        return [records[0]] + records[1:][-max_records:]
+    return records[-max_records:]
+
+
+def _is_greeting(record: dict) -> bool:
+    parts = record.get("parts", [])
+    return record.get("role") == "user" and len(parts) == 1 and bool(_GREETING_RE.fullmatch(str(parts[0])))
+
+
+def _drop_role_prompts(records: list[dict]) -> list[dict]:
+    # старый формат хранил ролевую инструкцию первой записью истории (а из-за полного
+    # перезаписывания — и в начале каждого дописанного блока). Роль теперь закреплена
+    # в ConversationContext, а сохранённая устарела, поэтому такие записи выбрасываем.
+    # Узнаём их по месту (перед приветствием со временем), а не по тексту: текст роли меняется
+    return [r for i, r in enumerate(records)
+            if not (r.get("role") == "user" and i + 1 < len(records) and _is_greeting(records[i + 1]))]
+
+
+def _shrink(records: list[dict]) -> list[dict]:
+    # реплики старого формата с полным текстом результатов поиска сводятся к короткой
+    # ссылке: в промпт они больше не попадают, а при сжатии файла уменьшают его;
+    # сохранённые ролевые инструкции удаляются (см. _drop_role_prompts)
+    records = _drop_role_prompts(records)
+    for r in records:
+        r["parts"] = [search_store.shrink_legacy(part) for part in r.get("parts", [])]
+    return records
+
+
+def _rewrite(path: Path, records: list[dict]) -> None:
+    tmp = path.with_suffix(".jsonl.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        for r in records:
+            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _compact(user_id: int, max_records: int) -> None:
+    path = _path(user_id)
+    records = _shrink(_bounded(_resolve(_read_tail(path, max_records)), max_records))
+    _rewrite(path, records)
+    _line_counts[user_id] = len(records)
+    logger.info(f"История пользователя {user_id} ужата до {len(records)} записей.")
+
+
+def _migrate_legacy(user_id: int, max_records: int) -> None:
+    # переносит историю из старого JSON-файла в JSONL
+    legacy = _legacy_path(user_id)
+    with open(legacy, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    records = _shrink(_bounded(_resolve(data if isinstance(data, list) else []), max_records))
+    _rewrite(_path(user_id), records)
+    legacy.unlink()
+    _line_counts[user_id] = len(records)
+    logger.info(f"История пользователя {user_id} перенесена в формат JSONL.")
@@ -0,0 +1,88 @@
+﻿# inbox.py - входящие сообщения пользователя: порядок и склейка «очередей» сообщений
+# Пользователи часто пишут операцию несколькими сообщениями подряд («обед», «500», «руб»).
+# Каждое сообщение попадает во входящую очередь своего пользователя; первое сообщение
+# серии ждёт, пока пользователь не замолчит на MESSAGE_DEBOUNCE_SEC (но не дольше
+# MESSAGE_DEBOUNCE_MAX_SEC), и вся серия обрабатывается одним ходом: один вызов модели
+# и одна классификация. Ходы одного пользователя идут строго по очереди под его
+# asyncio.Lock — это позволяет включить concurrent_updates, не ломая контекст диалога.
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
+
+import metrics
+from config import MESSAGE_DEBOUNCE_SEC, MESSAGE_DEBOUNCE_MAX_SEC
+
+logger = logging.getLogger(__name__)
+
+
+class _Inbox:
+    __slots__ = ("lock", "items", "first_at", "last_at", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.items: list = []       # сообщения, ещё не отданные в обработку
+        self.first_at = 0.0
+        self.last_at = 0.0
+        self.users = 0              # сколько корутин сейчас держат ссылку на очередь
+
+
+class Inboxes:
+
+    def __init__(self, handler: Callable[[list], Awaitable[None]],
+                 window: float = MESSAGE_DEBOUNCE_SEC, max_wait: float = MESSAGE_DEBOUNCE_MAX_SEC):
+        self.handler = handler
+        self.window = window
+        self.max_wait = max_wait
+        self._inboxes: dict[int, _Inbox] = {}
+
+    def _acquire(self, user_id: int) -> _Inbox:
+        inbox = self._inboxes.get(user_id)
+        if inbox is None:
+            inbox = self._inboxes[user_id] = _Inbox()
+        inbox.users += 1
+        return inbox
+
+    def _release(self, user_id: int, inbox: _Inbox) -> None:
+        inbox.users -= 1
+        if not inbox.users and not inbox.items:
+            self._inboxes.pop(user_id, None)
+
+    async def submit(self, user_id: int, item) -> None:
+        # кладёт сообщение в очередь пользователя. Если серия уже собирается (или ждёт
+        # окончания предыдущего хода), сообщение просто присоединяется к ней
+        inbox = self._acquire(user_id)
+        try:
+            now = time.monotonic()
+            inbox.items.append(item)
+            inbox.last_at = now
+            if len(inbox.items) > 1:
+                metrics.inc("inbox.merged")
+                return
+            inbox.first_at = now
+
+            # ждём паузы в сообщениях (скользящее окно, но не дольше max_wait)
+            while True:
+                now = time.monotonic()
+                delay = min(inbox.last_at + self.window, inbox.first_at + self.max_wait) - now
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+
+            # пока идёт предыдущий ход, новые сообщения продолжают копиться в этой серии
+            async with inbox.lock:
+                items, inbox.items = inbox.items, []
+                await self.handler(items)
+        finally:
+            self._release(user_id, inbox)
+
+    @asynccontextmanager
+    async def locked(self, user_id: int):
+        # выполняет действие между ходами пользователя (например, /reset)
+        inbox = self._acquire(user_id)
+        try:
+            async with inbox.lock:
+                yield
+        finally:
+            self._release(user_id, inbox)
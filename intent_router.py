@@ -0,0 +1,170 @@
+﻿# intent_router.py - быстрые ответы без модели: текущие дата/время и курсы валют
+# Частые вопросы («какое сегодня число», «курс доллара») распознаются по шаблонам
+# и отвечаются по локальным часам и таблице курсов, которая обновляется в фоне.
+# Всё, что распознать уверенно не удалось, уходит в модель как обычно.
+import asyncio
+import json
+import logging
+import re
+import time
+import urllib.request
+from datetime import datetime
+
+from config import CURRENCY_MAP, CURRENCY_RUB, RATES_REFRESH_SEC, RATES_MAX_AGE_SEC
+
+logger = logging.getLogger(__name__)
+
+
+# === Источники курсов ===
+
+class RatesProvider:
+    # источник курсов: fetch() возвращает {код валюты: рублей за 1 единицу}
+    source = ""
+
+    def fetch(self) -> dict[str, float]:
+        raise NotImplementedError
+
+
+class CbrRatesProvider(RatesProvider):
+    # официальные курсы ЦБ РФ (зеркало cbr-xml-daily.ru в формате JSON)
+    source = "ЦБ РФ"
+    url = "https://www.cbr-xml-daily.ru/daily_json.js"
+
+    def fetch(self) -> dict[str, float]:
+        with urllib.request.urlopen(self.url, timeout=10) as resp:
+            data = json.load(resp)
+        rates = {CURRENCY_RUB: 1.0}
+        for code, item in data.get("Valute", {}).items():
+            rates[code] = float(item["Value"]) / float(item.get("Nominal", 1))
+        return rates
+
+
+class StaticRatesProvider(RatesProvider):
+    # фиксированные курсы — для тестов и локального запуска без сети
+    source = "локальной таблицы"
+
+    def __init__(self, rates: dict[str, float]):
+        self.rates = dict(rates)
+
+    def fetch(self) -> dict[str, float]:
+        return dict(self.rates)
+
+
+class RatesTable:
+    # таблица курсов с фоновым обновлением; устаревшие курсы не отдаются
+
+    def __init__(self, provider: RatesProvider):
+        self.provider = provider
+        self.rates: dict[str, float] = {}
+        self.updated_at = 0.0
+        self._task: asyncio.Task | None = None
+
+    async def refresh(self) -> None:
+        try:
+            rates = await asyncio.to_thread(self.provider.fetch)
+        except Exception as e:
+            logger.warning(f"[intent_router] Не удалось обновить курсы валют: {e}")
+            return
+        self.rates, self.updated_at = rates, time.time()
+
+    def get(self, code: str) -> float | None:
+        if time.time() - self.updated_at > RATES_MAX_AGE_SEC:
+            return None
+        return self.rates.get(code)
+
+    async def _run(self) -> None:
+        while True:
+            await self.refresh()
+            await asyncio.sleep(RATES_REFRESH_SEC)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+rates_table = RatesTable(CbrRatesProvider())
+
+
+# === Распознавание намерений ===
+
+# вопрос о дате/времени должен составлять всё сообщение: допускаются только слова-связки
+# и знаки в конце («Скажи, какое сегодня число?»). Иначе «какая дата выплаты дивидендов»
+# или «сколько времени займёт накопить» получили бы ответ про сегодняшнюю дату.
+_FILLER = r"(?:скажи|подскажи|пожалуйста|а|ну|слушай|привет|джарвис|jarvis|сегодня|сейчас|точное|у\s+нас|у\s+тебя)"
+
+
+def _whole_message(core: str) -> re.Pattern:
+    return re.compile(rf"^(?:{_FILLER}[\s,]+)*(?:{core})(?:[\s,]+{_FILLER})*[\s?!.]*$")
+
+
+_DATE_RE = _whole_message(
+    r"(какое|какая|какой)\s+(сегодня\s+|сейчас\s+)?(число|дата|день)"
+    r"|(сегодняшн\w+|текущ\w+)\s+(число|дата)"
+)
+_TIME_RE = _whole_message(
+    r"котор\w+\s+(сейчас\s+)?час"
+    r"|сколько\s+(сейчас\s+)?времени"
+    r"|(какое|текущее)\s+(сейчас\s+)?время"
+)
+# слова, при которых вопрос о курсе уже не «справочный» и его лучше отдать модели;
+# сравниваются целыми словами (по основе), иначе «год» нашёлся бы в «сегодня»
+_RATE_STOP_RE = re.compile(
+    r"\b(?:прогноз\w*|будет|завтра|вчера|недел\w*|месяц\w*|год\w*|почему|динамик\w*|"
+    r"истори\w*|график\w*|биржев\w*|крипт\w*|биткоин\w*|акци\w*|стоит\s+ли|купить|продать)\b"
+)
+_MAX_INTENT_LEN = 80
+
+
+def _mentioned_currencies(text: str) -> list[str]:
+    # коды валют из CURRENCY_MAP в порядке упоминания
+    found: dict[str, int] = {}
+    for word, code in CURRENCY_MAP.items():
+        pos = text.find(word)
+        if pos >= 0 and (code not in found or pos < found[code]):
+            found[code] = pos
+    return sorted(found, key=found.get)
+
+
+def _format_rate(value: float) -> str:
+    return f"{value:,.4f}".replace(",", " ").rstrip("0").rstrip(".")
+
+
+def _route_rate(text: str) -> str | None:
+    if "курс" not in text or _RATE_STOP_RE.search(text) or re.search(r"\d", text):
+        return None
+    codes = _mentioned_currencies(text)
+    foreign = [c for c in codes if c != CURRENCY_RUB]
+    if len(foreign) == 1:
+        base, quote = foreign[0], CURRENCY_RUB
+    elif len(foreign) == 2 and CURRENCY_RUB not in codes:
+        base, quote = foreign
+    else:
+        return None
+
+    base_rub, quote_rub = rates_table.get(base), rates_table.get(quote)
+    if not base_rub or not quote_rub:
+        return None     # курсов нет или они устарели — пусть отвечает модель
+    updated = datetime.fromtimestamp(rates_table.updated_at).strftime("%d.%m.%Y %H:%M")
+    return (f"Курс: 1 {base} = {_format_rate(base_rub / quote_rub)} {quote} "
+            f"(по данным {rates_table.provider.source}, обновлено {updated}).")
+
+
+def route_intent(message: str) -> str | None:
+    # готовый ответ на частый вопрос или None, если вопрос нужно отдать модели
+    text = message.strip().lower()
+    if not text or len(text) > _MAX_INTENT_LEN:
+        return None
+    now = datetime.now()
+    if _DATE_RE.search(text):
+        return f"Сегодня {now.strftime('%d.%m.%Y')}"
+    if _TIME_RE.search(text):
+        return f"Сейчас {now.strftime('%H:%M')}"
+    return _route_rate(text)
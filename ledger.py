@@ -0,0 +1,312 @@
+﻿# ledger.py - локальная копия личных финансовых операций (SQLite)
+# Google-таблица остаётся основным хранилищем, а здесь лежит её зеркало с индексами
+# по пользователю, дате и категории: /chart и /export читают отсюда за миллисекунды,
+# не скачивая каждый раз весь лист. Подтверждённые операции попадают сюда сразу,
+# а периодическая сверка подтягивает правки, сделанные в таблице вручную.
+# Суммы по месяцу/категории/валюте ведутся нарастающим итогом (таблица aggregates
+# и её копия в памяти), так что сводки не пересчитывают операции заново.
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from config import LEDGER_RECONCILE_INTERVAL_SEC, LEDGER_SYNC_WAIT_SEC
+from google_sheet_client import get_user_rows, sheet_writer
+
+logger = logging.getLogger(__name__)
+
+_DB_PATH = config.LOG_DIR / "ledger.sqlite3"
+# все обращения к базе идут в одном потоке: соединение SQLite не делим между потоками
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ledger")
+_conn: sqlite3.Connection | None = None
+_task: asyncio.Task | None = None
+_aggregates: dict[int, "UserAggregates"] = {}   # кэш сумм по пользователям (только в потоке _executor)
+
+
+class LedgerSyncPending(Exception):
+    # история пользователя ещё не подтянута из таблицы: его строки не успели туда записаться
+    pass
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    id         INTEGER PRIMARY KEY,
+    user_id    INTEGER NOT NULL,
+    username   TEXT,
+    ts         TEXT NOT NULL,       -- "%Y-%m-%d %H:%M:%S", сортируется как строка
+    category   TEXT NOT NULL,
+    amount     REAL,                -- NULL, если сумму не удалось разобрать
+    amount_raw TEXT,
+    currency   TEXT,
+    source     TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_transactions_user_ts  ON transactions(user_id, ts);
+CREATE INDEX IF NOT EXISTS ix_transactions_user_cat ON transactions(user_id, category, ts);
+CREATE TABLE IF NOT EXISTS aggregates (
+    user_id  INTEGER NOT NULL,
+    month    TEXT NOT NULL,         -- "ГГГГ-ММ"
+    category TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    total    REAL NOT NULL,
+    count    INTEGER NOT NULL,
+    PRIMARY KEY (user_id, month, category, currency)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    user_id       INTEGER PRIMARY KEY,
+    reconciled_at REAL NOT NULL
+);
+"""
+
+
+def _db() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(_DB_PATH)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.executescript(_SCHEMA)
+    return _conn
+
+
+def _db_ready() -> None:
+    # схема создаётся при первом обращении к основному соединению
+    if _conn is None:
+        _executor.submit(_db).result()
+
+
+async def _run(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+
+def _parse_amount(value) -> float | None:
+    try:
+        return float(str(value).replace(" ", "").replace(",", "."))
+    except ValueError:
+        return None
+
+
+def _to_record(user_id: int, row: list) -> tuple:
+    # строка листа [User ID, Username, Дата и время, Категория, Сумма, Валюта, Источник] -> запись таблицы
+    row = list(row) + [""] * (7 - len(row))
+    return (user_id, row[1], row[2], str(row[3]).strip().lower(),
+            _parse_amount(row[4]), str(row[4]), row[5], row[6])
+
+
+class UserAggregates:
+    # нарастающие суммы операций пользователя; все сводки читаются отсюда за O(1)
+    def __init__(self):
+        self.cells: dict[tuple[str, str, str], list] = {}      # (месяц, категория, валюта) -> [сумма, кол-во]
+        self.by_category: dict[str, float] = {}                # категория -> сумма (для /chart)
+
+    def add(self, month: str, category: str, currency: str, total: float, count: int = 1) -> None:
+        cell = self.cells.setdefault((month, category, currency), [0.0, 0])
+        cell[0] += total
+        cell[1] += count
+        self.by_category[category] = self.by_category.get(category, 0.0) + total
+
+
+# === Работа с базой (только в потоке _executor) ===
+
+def _insert(conn: sqlite3.Connection, records: list[tuple]) -> None:
+    conn.executemany(
+        "INSERT INTO transactions (user_id, username, ts, category, amount, amount_raw, currency, source) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        records
+    )
+    conn.executemany(
+        "INSERT INTO aggregates (user_id, month, category, currency, total, count) VALUES (?, ?, ?, ?, ?, 1) "
+        "ON CONFLICT (user_id, month, category, currency) "
+        "DO UPDATE SET total = total + excluded.total, count = count + 1",
+        [(r[0], _month(r[2]), r[3], r[6] or "", r[4]) for r in records if r[4] is not None]
+    )
+
+
+def _month(ts: str) -> str:
+    return str(ts)[:7]
+
+
+def _add_rows(user_id: int, rows: list[list]) -> None:
+    records = [_to_record(user_id, row) for row in rows]
+    with _db() as conn:
+        _insert(conn, records)
+    # кэш обновляем только после успешной транзакции
+    agg = _aggregates.get(user_id)
+    if agg is not None:
+        for r in records:
+            if r[4] is not None:
+                agg.add(_month(r[2]), r[3], r[6] or "", r[4])
+
+
+def _rebuild_aggregates(conn: sqlite3.Connection, user_id: int) -> None:
+    conn.execute("DELETE FROM aggregates WHERE user_id = ?", (user_id,))
+    conn.execute(
+        "INSERT INTO aggregates (user_id, month, category, currency, total, count) "
+        "SELECT user_id, substr(ts, 1, 7), category, COALESCE(currency, ''), SUM(amount), COUNT(*) "
+        "FROM transactions WHERE user_id = ? AND amount IS NOT NULL "
+        "GROUP BY user_id, substr(ts, 1, 7), category, COALESCE(currency, '')",
+        (user_id,)
+    )
+    _aggregates.pop(user_id, None)
+
+
+def _replace_user(user_id: int, rows: list[list]) -> None:
+    # заменяет все операции пользователя содержимым его листа (одной транзакцией)
+    with _db() as conn:
+        conn.execute("DELETE FROM transactions WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM aggregates WHERE user_id = ?", (user_id,))
+        _insert(conn, [_to_record(user_id, row) for row in rows])
+        conn.execute("INSERT OR REPLACE INTO sync_state (user_id, reconciled_at) VALUES (?, ?)",
+                     (user_id, time.time()))
+    _aggregates.pop(user_id, None)
+
+
+def _check_consistency(user_id: int) -> bool:
+    # сравнивает нарастающие суммы с пересчётом по операциям; при расхождении пересобирает их
+    conn = _db()
+    stored = conn.execute(
+        "SELECT month, category, currency, ROUND(total, 6), count FROM aggregates "
+        "WHERE user_id = ? ORDER BY 1, 2, 3", (user_id,)
+    ).fetchall()
+    actual = conn.execute(
+        "SELECT substr(ts, 1, 7), category, COALESCE(currency, ''), ROUND(SUM(amount), 6), COUNT(*) "
+        "FROM transactions WHERE user_id = ? AND amount IS NOT NULL GROUP BY 1, 2, 3 ORDER BY 1, 2, 3",
+        (user_id,)
+    ).fetchall()
+    if stored == actual:
+        return True
+    logger.warning(f"[ledger] Суммы пользователя {user_id} разошлись с операциями, пересчитываем.")
+    with conn:
+        _rebuild_aggregates(conn, user_id)
+    return False
+
+
+def _user_aggregates(user_id: int) -> UserAggregates:
+    # суммы пользователя из кэша; при первом обращении за процесс — сверяем и загружаем из базы
+    agg = _aggregates.get(user_id)
+    if agg is None:
+        _check_consistency(user_id)
+        agg = UserAggregates()
+        for month, category, currency, total, count in _db().execute(
+                "SELECT month, category, currency, total, count FROM aggregates WHERE user_id = ?", (user_id,)):
+            agg.add(month, category, currency, total, count)
+        _aggregates[user_id] = agg
+    return agg
+
+
+def _is_synced(user_id: int) -> bool:
+    return _db().execute("SELECT 1 FROM sync_state WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+
+def _stale_users(before: float) -> list[int]:
+    rows = _db().execute("SELECT user_id FROM sync_state WHERE reconciled_at < ?", (before,)).fetchall()
+    # в режиме webhook каждый рабочий процесс сверяет только своих пользователей
+    return [user_id for (user_id,) in rows if user_id % config.WORKER_COUNT == config.WORKER_ID]
+
+
+def _category_totals(user_id: int) -> dict[str, float]:
+    return dict(_user_aggregates(user_id).by_category)
+
+
+def _monthly_totals(user_id: int) -> dict[tuple[str, str, str], float]:
+    return {key: cell[0] for key, cell in _user_aggregates(user_id).cells.items()}
+
+
+def iter_rows(user_id: int, date_from: str | None = None, date_to: str | None = None,
+              batch_size: int = 1000):
+    # строки пользователя в формате листа, отсортированные по дате; границы — строки
+    # "ГГГГ-ММ-ДД ЧЧ:ММ:СС". Читает порциями через собственное соединение (WAL позволяет
+    # читать параллельно с записью), поэтому годится для любого потока и не держит
+    # всю историю в памяти. Перед вызовом дождитесь ensure_synced(user_id).
+    query = ("SELECT user_id, username, ts, category, amount_raw, currency, source "
+             "FROM transactions WHERE user_id = ?")
+    params: list = [user_id]
+    if date_from:
+        query += " AND ts >= ?"
+        params.append(date_from)
+    if date_to:
+        query += " AND ts <= ?"
+        params.append(date_to)
+    query += " ORDER BY ts, id"
+
+    _db_ready()
+    conn = sqlite3.connect(_DB_PATH)
+    try:
+        cursor = conn.execute(query, params)
+        while batch := cursor.fetchmany(batch_size):
+            for row in batch:
+                yield list(row)
+    finally:
+        conn.close()
+
+
+# === Публичный интерфейс ===
+
+async def record_rows(user_id: int, rows: list[list]) -> None:
+    # добавляет подтверждённые пользователем строки (те же, что уходят в таблицу)
+    await _run(_add_rows, user_id, rows)
+
+
+async def category_totals(user_id: int) -> dict[str, float]:
+    await ensure_synced(user_id)
+    return await _run(_category_totals, user_id)
+
+
+async def monthly_totals(user_id: int) -> dict[tuple[str, str, str], float]:
+    # суммы по (месяц, категория, валюта)
+    await ensure_synced(user_id)
+    return await _run(_monthly_totals, user_id)
+
+
+async def check_consistency(user_id: int) -> bool:
+    return await _run(_check_consistency, user_id)
+
+
+async def ensure_synced(user_id: int) -> None:
+    # первый запрос пользователя: подтягиваем его историю из таблицы. Сверка не идёт, пока
+    # строки пользователя ждут записи, поэтому сначала дожидаемся их; не дождались —
+    # LedgerSyncPending, иначе сводки строились бы по неполному зеркалу
+    if await _run(_is_synced, user_id):
+        return
+    if not await sheet_writer.wait_user(user_id, LEDGER_SYNC_WAIT_SEC) or not await reconcile_user(user_id):
+        raise LedgerSyncPending(f"операции пользователя {user_id} ещё записываются в таблицу")
+
+
+async def reconcile_user(user_id: int) -> bool:
+    # сверяет зеркало с листом пользователя. Пока строки пользователя ждут записи
+    # в таблицу, сверку откладываем — иначе они пропали бы из зеркала.
+    if sheet_writer.has_pending(user_id):
+        return False
+    rows = await asyncio.to_thread(get_user_rows, user_id)
+    if sheet_writer.has_pending(user_id):
+        return False    # пока читали лист, пользователь подтвердил новую операцию
+    await _run(_replace_user, user_id, rows)
+    await check_consistency(user_id)
+    logger.info(f"[ledger] Операции пользователя {user_id} сверены с таблицей ({len(rows)} строк).")
+    return True
+
+
+async def _reconcile_loop() -> None:
+    while True:
+        await asyncio.sleep(LEDGER_RECONCILE_INTERVAL_SEC)
+        for user_id in await _run(_stale_users, time.time() - LEDGER_RECONCILE_INTERVAL_SEC):
+            try:
+                await reconcile_user(user_id)
+            except Exception as e:
+                logger.error(f"[ledger] Ошибка сверки операций пользователя {user_id}: {e}")
+
+
+def start() -> None:
+    global _task
+    _task = asyncio.create_task(_reconcile_loop())
+
+
+async def stop() -> None:
+    global _task
+    if _task:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
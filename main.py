@@ -1,5 +1,20 @@
-from telegram.ext import ApplicationBuilder
-from BestJarvisAI_Bot import app as bot_app
+import argparse
+
+from config import WEBHOOK_WORKERS, WEBHOOK_PORT
 
 if __name__ == '__main__':
-    bot_app.run_polling()
+    parser = argparse.ArgumentParser(description="BestJarvisAI_Bot")
+    parser.add_argument("--webhook", action="store_true",
+                        help="принимать апдейты через webhook в нескольких рабочих процессах")
+    parser.add_argument("--workers", type=int, default=WEBHOOK_WORKERS, help="рабочих процессов (webhook)")
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT, help="порт HTTP-сервера (webhook)")
+    parser.add_argument("--no-register", action="store_true",
+                        help="не вызывать setWebhook (например, при локальной проверке)")
+    args = parser.parse_args()
+
+    if args.webhook:
+        from webhook import run_webhook
+        run_webhook(workers=args.workers, port=args.port, register=not args.no_register)
+    else:
+        from BestJarvisAI_Bot import build_application
+        build_application().run_polling()
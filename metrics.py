@@ -0,0 +1,27 @@
+﻿# metrics.py - простые счётчики и показатели работы бота (для /stats и логов)
+# Всё хранится в памяти процесса и обнуляется при перезапуске.
+import time
+
+_started = time.time()
+_counters: dict[str, int] = {}
+_gauges: dict[str, float] = {}
+
+
+def inc(name: str, value: int = 1) -> None:
+    _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name: str, value: float) -> None:
+    _gauges[name] = value
+
+
+def get(name: str) -> int:
+    return _counters.get(name, 0)
+
+
+def snapshot() -> dict:
+    return {
+        "uptime_sec": int(time.time() - _started),
+        "counters": dict(sorted(_counters.items())),
+        "gauges": dict(sorted(_gauges.items())),
+    }
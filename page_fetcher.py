@@ -0,0 +1,155 @@
+﻿# page_fetcher.py - загрузка страниц из результатов поиска и извлечение основного текста
+# Страницы качаются одним общим httpx.AsyncClient (пул соединений, keep-alive, таймауты),
+# к одному хосту одновременно идёт не больше SEARCH_FETCH_PER_HOST запросов. Разбор HTML
+# занимает процессор, поэтому идёт в пуле процессов и не тормозит event loop.
+# httpx импортируется при первой загрузке, чтобы не замедлять запуск бота.
+import asyncio
+import logging
+import re
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+
+from config import (
+    SEARCH_FETCH_TIMEOUT_SEC, SEARCH_FETCH_MAX_CONNECTIONS, SEARCH_FETCH_PER_HOST,
+    SEARCH_FETCH_MAX_BYTES, SEARCH_EXTRACT_WORKERS
+)
+
+logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING)    # не пишем в лог каждый запрос
+
+_client = None      # httpx.AsyncClient
+_pool: ProcessPoolExecutor | None = None
+_host_limits: dict[str, asyncio.Semaphore] = {}
+
+_USER_AGENT = "Mozilla/5.0 (compatible; BestJarvisAI/1.0)"
+
+
+# === Извлечение текста (выполняется в рабочем процессе) ===
+
+class _TextExtractor(HTMLParser):
+    # собирает текст блочных элементов, пропуская скрипты, меню, шапки и подвалы
+    _SKIP = {"script", "style", "noscript", "nav", "header", "footer", "aside", "form", "svg", "iframe", "template"}
+    _BLOCKS = {"p", "div", "li", "h1", "h2", "h3", "h4", "h5", "h6", "td", "th", "pre",
+               "blockquote", "article", "section", "main", "br", "tr", "dd", "dt"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks: list[str] = []
+        self._current: list[str] = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._SKIP:
+            self._skip_depth += 1
+        elif tag in self._BLOCKS:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in self._SKIP:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in self._BLOCKS:
+            self._flush()
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self._current.append(data)
+
+    def _flush(self):
+        text = re.sub(r"\s+", " ", "".join(self._current)).strip()
+        self._current = []
+        # короткие обрывки — обычно пункты меню, кнопки и подписи
+        if len(text) >= 40:
+            self.blocks.append(text)
+
+
+def extract_text(html: str) -> str:
+    # основной текст страницы: абзацы через пустую строку
+    parser = _TextExtractor()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception:
+        pass    # битый HTML: берём то, что успели разобрать
+    parser._flush()
+    return "\n\n".join(dict.fromkeys(parser.blocks))    # повторяющиеся блоки убираем
+
+
+# === Загрузка ===
+
+def _get_client():
+    global _client
+    if _client is None:
+        import httpx
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(SEARCH_FETCH_TIMEOUT_SEC),
+            limits=httpx.Limits(max_connections=SEARCH_FETCH_MAX_CONNECTIONS,
+                                max_keepalive_connections=SEARCH_FETCH_MAX_CONNECTIONS),
+            follow_redirects=True,
+            headers={"User-Agent": _USER_AGENT, "Accept-Language": "ru,en;q=0.8"},
+        )
+    return _client
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=SEARCH_EXTRACT_WORKERS)
+    return _pool
+
+
+def _host_limit(url: str) -> asyncio.Semaphore:
+    host = urlsplit(url).netloc.lower()
+    sem = _host_limits.get(host)
+    if sem is None:
+        sem = _host_limits[host] = asyncio.Semaphore(SEARCH_FETCH_PER_HOST)
+    return sem
+
+
+async def fetch_html(url: str) -> str | None:
+    # HTML страницы (не больше SEARCH_FETCH_MAX_BYTES) или None, если это не HTML или ошибка
+    client = _get_client()
+    try:
+        async with _host_limit(url):
+            async with client.stream("GET", url) as resp:
+                if resp.status_code != 200 or "html" not in resp.headers.get("content-type", ""):
+                    return None
+                body = bytearray()
+                async for chunk in resp.aiter_bytes():
+                    body += chunk
+                    if len(body) >= SEARCH_FETCH_MAX_BYTES:
+                        break
+                return bytes(body).decode(resp.encoding or "utf-8", errors="replace")
+    except Exception as e:
+        logger.info(f"[page_fetcher] Не удалось загрузить {url}: {type(e).__name__} {e}")
+        return None
+
+
+async def fetch_pages(urls: list[str]) -> dict[str, str]:
+    # url -> основной текст страницы (только для успешно загруженных страниц)
+    htmls = await asyncio.gather(*(fetch_html(url) for url in urls))
+    loaded = [(url, html) for url, html in zip(urls, htmls) if html]
+    if not loaded:
+        return {}
+    # каждая страница разбирается в своём процессе пула
+    loop = asyncio.get_running_loop()
+    pool = _get_pool()
+    texts = await asyncio.gather(*(loop.run_in_executor(pool, extract_text, html) for _, html in loaded),
+                                 return_exceptions=True)
+    pages = {}
+    for (url, _), text in zip(loaded, texts):
+        if isinstance(text, Exception):
+            logger.error(f"[page_fetcher] Ошибка извлечения текста {url}: {text}")
+        elif text:
+            pages[url] = text
+    return pages
+
+
+async def close() -> None:
+    global _client, _pool
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
@@ -0,0 +1,181 @@
+﻿# search_client.py - интернет-поиск через DuckDuckGo с кэшем и объединением запросов
+# Результаты кэшируются по нормализованному тексту запроса (LRU + TTL; для курсов и
+# котировок TTL короткий), одинаковые одновременные запросы выполняются один раз,
+# а сессия DDGS переиспользуется в каждом рабочем потоке.
+# search_stage — поисковый этап для модели: несколько запросов параллельно, загрузка
+# первых страниц (page_fetcher) и сборка контекста из самых подходящих абзацев.
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import page_fetcher
+from config import (
+    SEARCH_CACHE_SIZE, SEARCH_TTL_SEC, SEARCH_TTL_VOLATILE_SEC, SEARCH_MAX_CONCURRENCY,
+    SEARCH_MAX_QUERIES, SEARCH_FETCH_PAGES, SEARCH_PAGE_MAX_CHARS, SEARCH_CONTEXT_MAX_CHARS
+)
+
+logger = logging.getLogger(__name__)
+
+# слова, по которым запрос считается «быстро меняющимся» (курсы, котировки, новости)
+_VOLATILE_WORDS = (
+    "курс", "котиров", "цена", "стоимост", "бирж", "акци", "индекс", "нефт", "золот",
+    "биткоин", "bitcoin", "btc", "новост", "сегодня", "rate", "price"
+)
+
+_executor = ThreadPoolExecutor(max_workers=SEARCH_MAX_CONCURRENCY, thread_name_prefix="search")
+_local = threading.local()      # сессия DDGS своя у каждого потока поиска
+_cache: OrderedDict[str, tuple[float, list[dict]]] = OrderedDict()   # запрос -> (истекает, результаты)
+_inflight: dict[str, asyncio.Future] = {}
+
+
+def normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query.strip().lower()).strip(" ?!.,;:«»\"'")
+
+
+def _ttl_for(query: str) -> float:
+    return SEARCH_TTL_VOLATILE_SEC if any(w in query for w in _VOLATILE_WORDS) else SEARCH_TTL_SEC
+
+
+def _cache_get(key: str) -> list[dict] | None:
+    item = _cache.get(key)
+    if item is None:
+        return None
+    expires, value = item
+    if expires < time.monotonic():
+        del _cache[key]
+        return None
+    _cache.move_to_end(key)
+    return value
+
+
+def _cache_put(key: str, value: list[dict]) -> None:
+    _cache[key] = (time.monotonic() + _ttl_for(key), value)
+    _cache.move_to_end(key)
+    while len(_cache) > SEARCH_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def _search_sync(query: str) -> list[dict]:
+    # блокирующий запрос к DuckDuckGo (выполняется в потоке _executor)
+    from duckduckgo_search import DDGS
+    ddgs = getattr(_local, "ddgs", None)
+    if ddgs is None:
+        ddgs = _local.ddgs = DDGS()
+    try:
+        results = ddgs.text(query, region='wt-wt', safesearch='moderate', max_results=5)
+    except Exception:
+        _local.ddgs = None      # сессия могла испортиться — в следующий раз создадим новую
+        raise
+    return [
+        {"title": res.get("title", ""), "body": res.get("body", ""), "url": res.get("href", "")}
+        for res in results or []
+    ]
+
+
+async def _search_and_cache(key: str, query: str) -> list[dict] | None:
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(_executor, _search_sync, query)
+    except Exception as e:
+        logger.error(f"Ошибка поиска DuckDuckGo: {e}")
+        return None     # ошибки не кэшируем
+    _cache_put(key, result)
+    return result
+
+
+async def search_results(query: str) -> list[dict] | None:
+    # результаты DuckDuckGo [{"title", "body", "url"}] или None при ошибке поиска
+    key = normalize_query(query)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_search_and_cache(key, query))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield: отмена одного ожидающего не должна отменять поиск для остальных
+    return await asyncio.shield(task)
+
+
+async def web_search(query: str) -> str:
+    # сниппеты одного запроса текстом (для /search)
+    results = await search_results(query)
+    if results is None:
+        return "⚠️ Ошибка при поиске в интернете."
+    snippets = [f"{res['title']}\n{res['body']}\n{res['url']}" for res in results]
+    return "\n\n---\n\n".join(snippets) if snippets else "По результату ничего не найдено."
+
+
+# === Поисковый этап для модели ===
+
+def _stems(text: str) -> set[str]:
+    # грубые основы слов: первых 5 букв хватает, чтобы «курс» / «курса» / «курсом» совпали
+    return {word[:5] for word in re.findall(r"\w{3,}", text.lower().replace("ё", "е"))}
+
+
+def rank_sources(queries: list[str], results: list[list[dict] | None], pages: dict[str, str],
+                 max_chars: int = SEARCH_CONTEXT_MAX_CHARS) -> list[dict]:
+    # источники для модели [{"title", "url", "snippet", "text"}]: text — сниппет и абзацы
+    # страницы, больше всего совпадающие со словами запроса. Источники упорядочены
+    # по совпадению (при равенстве — по месту в выдаче), общий объём ограничен.
+    scored_sources = []
+    seen = set()
+    for query, items in zip(queries, results):
+        stems = _stems(query)
+        for rank, res in enumerate(items or []):
+            if res["url"] in seen:
+                continue
+            seen.add(res["url"])
+            paragraphs = [p[:SEARCH_PAGE_MAX_CHARS] for p in pages.get(res["url"], "").split("\n\n") if p]
+            scored = sorted(((len(stems & _stems(p)), i) for i, p in enumerate(paragraphs)), reverse=True)
+            picked, size = [], len(res["body"])
+            for score, i in scored:
+                if score == 0:
+                    break
+                if size + len(paragraphs[i]) <= SEARCH_PAGE_MAX_CHARS:
+                    picked.append(i)
+                    size += len(paragraphs[i])
+            relevance = len(stems & _stems(f"{res['title']} {res['body']}")) + sum(s for s, _ in scored[:3])
+            text = "\n".join([res["body"]] + [paragraphs[i] for i in sorted(picked)]).strip()
+            source = {"title": res["title"], "url": res["url"], "snippet": res["body"], "text": text}
+            scored_sources.append((relevance, -rank, source))
+
+    sources, total = [], 0
+    for _, _, source in sorted(scored_sources, key=lambda s: s[:2], reverse=True):
+        size = len(source["title"]) + len(source["url"]) + len(source["text"]) + 10
+        if total + size > max_chars:
+            if sources:
+                continue    # следующий источник может оказаться короче
+            source = dict(source, text=source["text"][:max_chars])
+        sources.append(source)
+        total += size
+    return sources
+
+
+def format_sources(sources: list[dict]) -> str:
+    blocks = [f"[{n}] {src['title']}\n{src['url']}\n{src['text']}".strip() for n, src in enumerate(sources, 1)]
+    return "\n\n".join(blocks) if blocks else "По результату ничего не найдено."
+
+
+async def collect_sources(queries: list[str], results: list[list[dict] | None]) -> list[dict]:
+    # загружает первые страницы каждого запроса и отбирает из них источники
+    urls = list(dict.fromkeys(
+        res["url"] for items in results for res in (items or [])[:SEARCH_FETCH_PAGES] if res["url"]
+    ))
+    pages = await page_fetcher.fetch_pages(urls)
+    return rank_sources(queries, results, pages)
+
+
+async def search_stage(queries: list[str]) -> list[dict] | None:
+    # поисковый этап: все запросы модели за один ход выполняются параллельно.
+    # None — поиск не удался ни по одному запросу
+    queries = list(dict.fromkeys(q.strip() for q in queries if q.strip()))[:SEARCH_MAX_QUERIES]
+    results = await asyncio.gather(*(search_results(q) for q in queries))
+    if all(items is None for items in results):
+        return None
+    return await collect_sources(queries, results)
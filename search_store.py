@@ -0,0 +1,88 @@
+﻿# search_store.py - результаты интернет-поиска отдельно от истории диалога
+# Источник хранится один раз под ключом — хэшем адреса и сниппета: одна и та же страница
+# из разных поисков (и у разных пользователей) не дублируется. Каждый поисковый этап
+# получает короткую ссылку (ref) на свой набор источников. В историю диалога пишется
+# только строка со ссылкой и адресами, а полный текст результатов попадает в промпт
+# на текущем этапе поиска и в уточняющих вопросах сразу после него (по ссылке из
+# последних реплик, см. latest). Записи живут SEARCH_STORE_TTL_SEC.
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from typing import Iterable
+
+import metrics
+from config import SEARCH_STORE_TTL_SEC, SEARCH_STORE_MAX_SOURCES, SEARCH_STORE_MAX_CYCLES
+
+_sources: OrderedDict[str, tuple[float, dict]] = OrderedDict()                   # ключ -> (истекает, источник)
+_cycles: OrderedDict[str, tuple[float, list[str], list[str]]] = OrderedDict()    # ref -> (истекает, запросы, ключи)
+
+# начало реплики с результатами поиска в истории старого формата
+LEGACY_RESULTS_PREFIX = "Вот, что удалось найти по теме: «"
+# ссылка на поисковый этап в реплике, записанной reference()
+_REF_RE = re.compile(r"\[Поиск #([0-9a-f]{8}):")
+
+
+def source_key(url: str, snippet: str) -> str:
+    return hashlib.sha256(f"{url}\n{snippet}".encode()).hexdigest()[:16]
+
+
+def _expire(store: OrderedDict, limit: int) -> None:
+    # записи добавляются в конец, поэтому самые старые (и раньше всех истекающие) — в начале
+    now = time.monotonic()
+    while store and (len(store) > limit or next(iter(store.values()))[0] < now):
+        store.popitem(last=False)
+
+
+def put(queries: list[str], sources: list[dict]) -> str:
+    # сохраняет результаты поискового этапа и возвращает ссылку на них
+    expires = time.monotonic() + SEARCH_STORE_TTL_SEC
+    keys = []
+    for src in sources:
+        key = source_key(src["url"], src["snippet"])
+        if key in _sources:
+            metrics.inc("search_store.dedup")
+        _sources[key] = (expires, src)
+        _sources.move_to_end(key)
+        keys.append(key)
+    ref = hashlib.sha256("\n".join(queries + keys).encode()).hexdigest()[:8]
+    _cycles[ref] = (expires, list(queries), keys)
+    _cycles.move_to_end(ref)
+    _expire(_sources, SEARCH_STORE_MAX_SOURCES)
+    _expire(_cycles, SEARCH_STORE_MAX_CYCLES)
+    metrics.set_gauge("search_store.sources", len(_sources))
+    return ref
+
+
+def get(ref: str) -> list[dict] | None:
+    # источники этапа или None, если ссылка неизвестна или устарела
+    item = _cycles.get(ref)
+    if item is None or item[0] < time.monotonic():
+        return None
+    sources = [_sources[key][1] for key in item[2] if key in _sources]
+    return sources if len(sources) == len(item[2]) else None
+
+
+def latest(parts: Iterable[str]) -> tuple[str, list[dict]] | None:
+    # первая по порядку ссылка на поиск среди реплик (передавайте от новых к старым),
+    # результаты которой ещё хранятся: (ref, источники) или None
+    for part in parts:
+        for ref in reversed(_REF_RE.findall(part) if isinstance(part, str) else []):
+            sources = get(ref)
+            if sources is not None:
+                return ref, sources
+    return None
+
+
+def reference(ref: str, queries: list[str], sources: list[dict]) -> str:
+    # короткая запись о поиске для истории диалога
+    urls = ", ".join(src["url"] for src in sources) or "ничего не найдено"
+    return f"[Поиск #{ref}: «{' | '.join(queries)}». Источники: {urls}]"
+
+
+def shrink_legacy(part: str) -> str:
+    # реплику старого формата (с полным текстом результатов) сводит к строке-ссылке
+    if not isinstance(part, str) or not part.startswith(LEGACY_RESULTS_PREFIX):
+        return part
+    query = part[len(LEGACY_RESULTS_PREFIX):].split("»", 1)[0]
+    return f"[Поиск: «{query}». Результаты устарели и не сохраняются]"
@@ -0,0 +1,171 @@
+﻿# session_store.py - контексты диалогов пользователей в памяти и неподтверждённые операции
+# SessionStore держит ConversationContext только активных пользователей: порядок словаря —
+# порядок последнего обращения, поэтому вытеснение идёт с начала. Контекст выгружается,
+# если пользователь молчит дольше SESSION_IDLE_SEC, если контекстов больше
+# SESSION_MAX_USERS или если их примерный объём превысил SESSION_MEMORY_LIMIT_MB.
+# Перед выгрузкой несохранённые реплики дописываются на диск (on_evict), и при следующем
+# сообщении контекст просто загружается заново. PendingStore хранит найденные операции
+# до нажатия «Да/Нет», но не дольше PENDING_TTL_SEC.
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable
+
+import metrics
+from config import (
+    SESSION_MAX_USERS, SESSION_IDLE_SEC, SESSION_MEMORY_LIMIT_MB,
+    SESSION_SWEEP_INTERVAL_SEC, PENDING_TTL_SEC
+)
+from conversation import ConversationContext
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore:
+
+    def __init__(self, on_evict: Callable[[int, ConversationContext], None],
+                 max_users: int = SESSION_MAX_USERS, idle_sec: float = SESSION_IDLE_SEC,
+                 memory_limit: int = SESSION_MEMORY_LIMIT_MB * 1024 * 1024):
+        self.on_evict = on_evict
+        self.max_users = max_users
+        self.idle_sec = idle_sec
+        self.memory_limit = memory_limit
+        self._sessions: OrderedDict[int, ConversationContext] = OrderedDict()
+        self._used_at: dict[int, float] = {}
+        self._sizes: dict[int, int] = {}    # объём контекста на момент последнего touch()
+        self._total_size = 0
+        metrics.set_gauge("sessions.limit_bytes", memory_limit)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, user_id: int) -> ConversationContext | None:
+        ctx = self._sessions.get(user_id)
+        if ctx is not None:
+            self._sessions.move_to_end(user_id)
+            self._used_at[user_id] = time.monotonic()
+        return ctx
+
+    def put(self, user_id: int, ctx: ConversationContext) -> None:
+        self.discard(user_id)
+        self._sessions[user_id] = ctx
+        self._used_at[user_id] = time.monotonic()
+        self._sizes[user_id] = 0
+        self.touch(user_id)
+
+    def touch(self, user_id: int) -> None:
+        # пересчитывает объём контекста после изменения и при превышении пределов
+        # выгружает самые давно использованные (текущий контекст не трогаем)
+        ctx = self._sessions.get(user_id)
+        if ctx is None:
+            return
+        size = ctx.memory_size()
+        self._total_size += size - self._sizes[user_id]
+        self._sizes[user_id] = size
+        while len(self._sessions) > 1 and (len(self._sessions) > self.max_users
+                                           or self._total_size > self.memory_limit):
+            oldest = next(iter(self._sessions))
+            if oldest == user_id:
+                break
+            self._evict(oldest)
+        self._report()
+
+    def discard(self, user_id: int) -> None:
+        # убирает контекст без сохранения (например, при /reset)
+        if self._sessions.pop(user_id, None) is not None:
+            self._used_at.pop(user_id, None)
+            self._total_size -= self._sizes.pop(user_id, 0)
+            self._report()
+
+    def sweep(self) -> None:
+        # выгружает контексты пользователей, молчащих дольше idle_sec
+        deadline = time.monotonic() - self.idle_sec
+        while self._sessions:
+            oldest = next(iter(self._sessions))
+            if self._used_at[oldest] > deadline:
+                break
+            self._evict(oldest)
+        self._report()
+
+    def flush(self) -> None:
+        # выгружает всё (при остановке бота)
+        while self._sessions:
+            self._evict(next(iter(self._sessions)))
+        self._report()
+
+    def _evict(self, user_id: int) -> None:
+        ctx = self._sessions[user_id]
+        try:
+            self.on_evict(user_id, ctx)
+        except Exception as e:
+            logger.error(f"[session_store] Не удалось сохранить контекст {user_id} перед выгрузкой: {e}")
+        self.discard(user_id)
+        metrics.inc("sessions.evicted")
+
+    def _report(self) -> None:
+        metrics.set_gauge("sessions.count", len(self._sessions))
+        metrics.set_gauge("sessions.bytes", self._total_size)
+
+
+class PendingStore:
+    # найденные операции, ждущие подтверждения: user_id -> (строки, момент истечения)
+
+    def __init__(self, ttl: float = PENDING_TTL_SEC):
+        self.ttl = ttl
+        self._items: dict[int, tuple[list[list[str]], float]] = {}
+
+    def put(self, user_id: int, rows: list[list[str]]) -> None:
+        self._items[user_id] = (rows, time.monotonic() + self.ttl)
+        metrics.set_gauge("pending.count", len(self._items))
+
+    def pop(self, user_id: int) -> list[list[str]] | None:
+        # забирает операции пользователя; просроченные считаются отменёнными
+        rows, expires_at = self._items.pop(user_id, (None, 0.0))
+        metrics.set_gauge("pending.count", len(self._items))
+        if rows is not None and expires_at < time.monotonic():
+            metrics.inc("pending.expired")
+            return None
+        return rows
+
+    def sweep(self) -> None:
+        now = time.monotonic()
+        expired = [uid for uid, (_, expires_at) in self._items.items() if expires_at < now]
+        for uid in expired:
+            del self._items[uid]
+        if expired:
+            metrics.inc("pending.expired", len(expired))
+        metrics.set_gauge("pending.count", len(self._items))
+
+
+class Sweeper:
+    # фоновая задача, которая периодически чистит хранилища
+
+    def __init__(self, *stores, interval: float = SESSION_SWEEP_INTERVAL_SEC):
+        self.stores = stores
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            for store in self.stores:
+                try:
+                    store.sweep()
+                except Exception as e:
+                    logger.error(f"[session_store] Ошибка при очистке {type(store).__name__}: {e}")
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
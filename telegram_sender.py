@@ -0,0 +1,171 @@
+﻿# telegram_sender.py - все исходящие сообщения бота идут через общий диспетчер
+# Telegram ограничивает частоту отправки: около 30 сообщений в секунду на бота и около
+# одного в секунду в один чат (правки сообщений тоже считаются). Диспетчер держит
+# «ведро токенов» на весь бот и на каждый чат; вызов ждёт, пока в обоих вёдрах есть
+# токен. На RetryAfter чат ставится на паузу на указанное Telegram время и вызов
+# повторяется; на TimedOut — повтор с нарастающей паузой. Длинные ответы режутся на
+# части не длиннее TELEGRAM_MAX_MESSAGE_LEN по абзацам, строкам или словам.
+# В режиме webhook у каждого рабочего процесса свой диспетчер, поэтому общий лимит
+# делится поровну между процессами (чаты закреплены за процессами, их лимит не делится).
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter, TimedOut
+
+import config
+import metrics
+from config import (
+    TELEGRAM_MAX_MESSAGE_LEN, TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE,
+    TELEGRAM_CHAT_BURST, TELEGRAM_SEND_RETRIES
+)
+
+logger = logging.getLogger(__name__)
+
+_MAX_CHAT_BUCKETS = 10000   # дальше вёдра неактивных чатов выбрасываются
+
+
+def split_text(text: str, limit: int = TELEGRAM_MAX_MESSAGE_LEN) -> list[str]:
+    # делит текст на части не длиннее limit, стараясь резать по границе абзаца,
+    # строки, предложения или слова (но не раньше середины части)
+    text = text.strip()
+    chunks = []
+    while len(text) > limit:
+        cut = limit
+        for sep in ("\n\n", "\n", ". ", " "):
+            pos = text.rfind(sep, limit // 2, limit)
+            if pos > 0:
+                cut = pos + (1 if sep == ". " else 0)
+                break
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()      # ожидающие вызовы одного чата идут по очереди
+
+    def delay(self) -> float:
+        # через сколько секунд можно будет взять токен
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(0.0, self.paused_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        return self.delay() == 0 and self.tokens >= self.capacity and not self.lock.locked()
+
+
+class TelegramSender:
+
+    def __init__(self, global_rate: float | None = None, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: float = TELEGRAM_CHAT_BURST, retries: int = TELEGRAM_SEND_RETRIES):
+        if global_rate is None:
+            # WORKER_COUNT выставляется webhook.py до импорта бота
+            global_rate = TELEGRAM_GLOBAL_RATE / max(1, config.WORKER_COUNT)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._chats: dict[int, TokenBucket] = {}
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= _MAX_CHAT_BUCKETS:
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.idle()}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def ready(self, chat_id: int) -> bool:
+        # можно ли отправить в чат прямо сейчас, не дожидаясь токена
+        bucket = self._bucket(chat_id)
+        return not bucket.lock.locked() and self._global.delay() == 0 and bucket.delay() == 0
+
+    async def _acquire(self, chat_id: int) -> None:
+        bucket = self._bucket(chat_id)
+        async with bucket.lock:
+            while True:
+                wait = max(self._global.delay(), bucket.delay())
+                if wait <= 0:
+                    break
+                metrics.inc("telegram.throttled")
+                await asyncio.sleep(wait)
+            self._global.take()
+            bucket.take()
+
+    async def run(self, chat_id: int, func: Callable[..., Awaitable], *args, **kwargs):
+        # выполняет вызов Bot API в пределах лимитов, с повторами на RetryAfter и TimedOut
+        for attempt in range(self.retries + 1):
+            await self._acquire(chat_id)
+            try:
+                result = await func(*args, **kwargs)
+                metrics.inc("telegram.sent")
+                return result
+            except RetryAfter as e:
+                metrics.inc("telegram.retry_after")
+                logger.warning(f"[telegram_sender] Flood control в чате {chat_id}, пауза {e.retry_after} с")
+                self._bucket(chat_id).pause(e.retry_after)
+                if attempt == self.retries:
+                    raise
+            except TimedOut:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+            # файл при повторе нужно отправить с начала
+            for value in kwargs.values():
+                if hasattr(value, "seek"):
+                    value.seek(0)
+
+    async def reply(self, message: Message, text: str, **kwargs) -> Message | None:
+        # ответ на сообщение; длинный текст уходит несколькими сообщениями,
+        # клавиатура и прочие параметры — только у последнего
+        return await self.reply_chunks(message, split_text(text), **kwargs)
+
+    async def reply_chunks(self, message: Message, chunks: list[str], **kwargs) -> Message | None:
+        if len(chunks) > 1:
+            metrics.inc("telegram.split")
+        sent = None
+        for i, chunk in enumerate(chunks):
+            extra = kwargs if i == len(chunks) - 1 else {}
+            sent = await self.run(message.chat_id, message.reply_text, chunk, **extra)
+        return sent
+
+    async def edit(self, message: Message, text: str, **kwargs) -> bool:
+        try:
+            await self.run(message.chat_id, message.edit_text, text, **kwargs)
+            return True
+        except BadRequest as e:
+            if "not modified" in str(e):
+                return True
+            raise
+
+    async def delete(self, message: Message) -> bool:
+        try:
+            return await self.run(message.chat_id, message.delete)
+        except Exception as e:
+            logger.warning(f"[telegram_sender] Не удалось удалить сообщение: {e}")
+            return False
+
+
+sender = TelegramSender()
@@ -0,0 +1,21 @@
+﻿# conftest.py - окружение для тестов
+# config.py при импорте читает config.json с ключами API и без него завершает процесс,
+# поэтому до импорта модулей бота подставляем временный конфиг с фиктивными значениями.
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+_tmp = Path(tempfile.mkdtemp(prefix="jarvis-tests-"))
+(_tmp / "config.json").write_text(json.dumps({
+    "PVY_GEMINI_API_KEY": "test",
+    "BESTJARVISAI_BOT_TELEGRAM_BOT_TOKEN": "0:test",
+    "GOOGLE_CREDENTIALS_PATH": "test.json",
+    "FINANCIAL_BOT_PROJECT_ID": "test",
+    "GOOGLE_VORTEXAI_APPLICATION_CREDENTIALS": "test.json",
+    "LOG_DIR": str(_tmp / "logs"),
+}), encoding="utf-8")
+os.environ["CONFIG_JSON_PATH"] = str(_tmp / "config.json")
@@ -0,0 +1,29 @@
+﻿# test_classifier.py - локальный фильтр сообщений перед классификатором (gate, parse_simple)
+import pytest
+
+from classifier import GATE_LLM, GATE_LOCAL, GATE_SKIP, gate, parse_simple
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("Привет!", GATE_SKIP),
+    ("Посоветуй, во что стоит инвестировать", GATE_SKIP),
+    ("Расскажи о стоимости акций Сбера", GATE_SKIP),
+    ("Как сэкономить на семье", GATE_SKIP),
+    ("Какие акции подходят для одинокого инвестора", GATE_SKIP),
+    ("Сколько я потратил в марте?", GATE_SKIP),
+    ("кофе 300 руб", GATE_LOCAL),
+    ("зарплата $1500", GATE_LOCAL),
+    ("потратил сто рублей на обед", GATE_LLM),
+    ("отдал семь тысяч за ремонт", GATE_LLM),
+    ("получил 5к премии", GATE_LLM),
+    ("кофе 300 руб и такси 500 руб", GATE_LLM),
+    ("хочу купить телефон за 30000 руб", GATE_LLM),
+])
+def test_gate(message, expected):
+    assert gate(message) == expected
+
+
+def test_parse_simple():
+    assert parse_simple("зарплата $1500") == [
+        {"category": "доход", "amount": "1500", "currency": "USD", "text": "зарплата $1500"}
+    ]
@@ -0,0 +1,32 @@
+﻿# test_history_store.py - перенос историй старого формата (JSON) в JSONL
+import json
+
+import config
+import history_store
+from conversation import ConversationContext
+
+OLD_ROLE = "Ты — финансовый ассистент JARVIS (старая версия инструкции)."
+NEW_ROLE = "Ты — финансовый ассистент JARVIS."
+
+
+def test_legacy_role_prompt_is_dropped():
+    user_id = 1001
+    legacy = [
+        {"role": "user", "parts": [OLD_ROLE]},
+        {"role": "user", "parts": ["Сейчас 01.03.2024 10:00."]},
+        {"role": "user", "parts": ["кофе 300 руб"]},
+        {"role": "model", "parts": ["Записал."]},
+        # старое сохранение дописывало всю историю целиком, роль повторялась в начале блока
+        {"role": "user", "parts": [OLD_ROLE]},
+        {"role": "user", "parts": ["Сейчас 02.03.2024 09:00."]},
+        {"role": "user", "parts": ["Какой курс доллара?"]},
+    ]
+    (config.LOG_DIR / f"{user_id}.json").write_text(json.dumps(legacy, ensure_ascii=False), encoding="utf-8")
+
+    records = history_store.load_records(user_id, 100).result()
+
+    assert all(r["parts"] != [OLD_ROLE] for r in records)
+    assert [r["parts"][0] for r in records][-1] == "Какой курс доллара?"
+    assert not (config.LOG_DIR / f"{user_id}.json").exists()
+    prompt = ConversationContext(NEW_ROLE, records).prompt()
+    assert prompt.startswith(NEW_ROLE) and OLD_ROLE not in prompt
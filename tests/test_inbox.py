@@ -0,0 +1,23 @@
+﻿# test_inbox.py - склейка серии сообщений пользователя в один ход
+import asyncio
+
+from inbox import Inboxes
+
+
+def test_typed_burst_is_one_turn():
+    # «обед», «500», «руб» отдельными сообщениями с паузой, с какой их набирают
+    turns = []
+
+    async def handler(items):
+        turns.append(items)
+
+    async def main():
+        inboxes = Inboxes(handler)
+        tasks = []
+        for text in ("обед", "500", "руб"):
+            tasks.append(asyncio.create_task(inboxes.submit(1, text)))
+            await asyncio.sleep(0.6)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert turns == [["обед", "500", "руб"]]
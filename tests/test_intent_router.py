@@ -0,0 +1,51 @@
+﻿# test_intent_router.py - быстрые ответы без модели (route_intent)
+import asyncio
+import time
+
+import pytest
+
+from config import CURRENCY_RUB, RATES_MAX_AGE_SEC
+from intent_router import StaticRatesProvider, rates_table, route_intent
+
+RATES = {CURRENCY_RUB: 1.0, "USD": 90.0, "EUR": 99.0, "CNY": 12.5}
+
+
+@pytest.fixture(autouse=True)
+def static_rates(monkeypatch):
+    monkeypatch.setattr(rates_table, "provider", StaticRatesProvider(RATES))
+    asyncio.run(rates_table.refresh())
+
+
+# сообщение -> начало ответа
+@pytest.mark.parametrize("message, expected", [
+    ("Какое сегодня число?", "Сегодня "),
+    ("Скажи, какая сегодня дата", "Сегодня "),
+    ("текущая дата?", "Сегодня "),
+    ("Который час?", "Сейчас "),
+    ("сколько сейчас времени", "Сейчас "),
+    ("Курс доллара", "Курс: 1 USD = 90 RUB"),
+    ("Какой курс доллара сегодня?", "Курс: 1 USD = 90 RUB"),
+    ("курс доллара на сегодня", "Курс: 1 USD = 90 RUB"),
+    ("курс евро к доллару?", "Курс: 1 EUR = 1.1 USD"),
+])
+def test_answered_locally(message, expected):
+    assert (route_intent(message) or "").startswith(expected)
+
+
+# вопросы, которые должны уйти в модель
+@pytest.mark.parametrize("message", [
+    "Какая дата выплаты дивидендов Сбербанка?",
+    "Какой день лучше для покупки валюты?",
+    "Сколько времени займёт накопить на квартиру?",
+    "Какое время лучше для ребалансировки портфеля?",
+    "Какой прогноз курса доллара на месяц?",
+    "Курс доллара за год",
+    "Курс доллара 95, стоит ли покупать?",
+])
+def test_left_to_model(message):
+    assert route_intent(message) is None
+
+
+def test_stale_rates_go_to_model(monkeypatch):
+    monkeypatch.setattr(rates_table, "updated_at", time.time() - RATES_MAX_AGE_SEC - 1)
+    assert route_intent("Курс доллара") is None
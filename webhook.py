@@ -0,0 +1,203 @@
+﻿# webhook.py - режим webhook: HTTP-сервер принимает апдейты Telegram и раздаёт их рабочим процессам
+# Главный процесс лёгкий (только stdlib и config): он принимает POST от Telegram и
+# кладёт апдейт в очередь процесса номер user_id % WEBHOOK_WORKERS. Так все апдейты
+# одного пользователя попадают в один процесс, и его user_histories / pending остаются
+# локальными. Каждый рабочий процесс поднимает своё приложение PTB без Updater.
+# При остановке (SIGTERM / Ctrl+C) сервер перестаёт принимать запросы, а процессы
+# дорабатывают уже принятые апдейты и корректно останавливают фоновые службы.
+import asyncio
+import json
+import logging
+import multiprocessing as mp
+import queue
+import signal
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+from config import (
+    WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_WORKERS,
+    WEBHOOK_QUEUE_SIZE, WEBHOOK_DRAIN_TIMEOUT_SEC
+)
+
+logger = logging.getLogger(__name__)
+
+# виды апдейтов, в которых есть отправитель (from / user) или чат
+_UPDATE_KINDS = (
+    "message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+    "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+    "chat_join_request", "channel_post", "edited_channel_post"
+)
+
+
+def update_user_id(data: dict) -> int:
+    # id пользователя (или чата), по которому апдейт закрепляется за рабочим процессом
+    for kind in _UPDATE_KINDS:
+        obj = data.get(kind)
+        if not obj:
+            continue
+        sender = obj.get("from") or obj.get("user")
+        if sender:
+            return sender["id"]
+        if obj.get("chat"):
+            return obj["chat"]["id"]
+    return 0
+
+
+# === Рабочий процесс ===
+
+def _worker_main(index: int, count: int, updates: mp.Queue) -> None:
+    # номер процесса выставляем до импорта бота: от него зависят пути журналов и сверка ledger
+    config.WORKER_ID, config.WORKER_COUNT = index, count
+    # сигналы остановки обрабатывает главный процесс и присылает в очередь None
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_serve_worker(index, updates))
+
+
+async def _serve_worker(index: int, updates: mp.Queue) -> None:
+    from telegram import Update
+    from BestJarvisAI_Bot import build_application
+
+    app = build_application(webhook=True)
+    loop = asyncio.get_running_loop()
+    async with app:     # initialize() / shutdown()
+        await app.post_init(app)
+        await app.start()
+        logger.info(f"[webhook] Рабочий процесс {index} запущен")
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            try:
+                await app.update_queue.put(Update.de_json(data, app.bot))
+            except Exception as e:
+                logger.error(f"[webhook] Не удалось разобрать апдейт {data.get('update_id')}: {e}")
+        # stop() дожидается обработки всех уже поставленных в очередь апдейтов
+        logger.info(f"[webhook] Рабочий процесс {index} дорабатывает очередь")
+        await app.stop()
+        await app.post_shutdown(app)
+    logger.info(f"[webhook] Рабочий процесс {index} остановлен")
+
+
+# === HTTP-сервер ===
+
+class _UpdateHandler(BaseHTTPRequestHandler):
+    server: "WebhookServer"
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            return self._reply(404)
+        secret = config.WEBHOOK_SECRET
+        if secret and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            return self._reply(403)
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except (ValueError, json.JSONDecodeError):
+            return self._reply(400)
+        # 503 — Telegram повторит доставку позже, апдейт не потеряется
+        self._reply(200 if self.server.dispatch(data) else 503)
+
+    def _reply(self, status: int) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, fmt, *args):
+        logger.debug(f"[webhook] {self.address_string()} {fmt % args}")
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, workers: int, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT):
+        super().__init__((host, port), _UpdateHandler)
+        self.workers = workers
+        self.queues = [mp.Queue(WEBHOOK_QUEUE_SIZE) for _ in range(workers)]
+        self.processes: list[mp.Process | None] = [None] * workers
+        self.draining = False
+
+    def dispatch(self, data: dict) -> bool:
+        if self.draining:
+            return False
+        try:
+            self.queues[update_user_id(data) % self.workers].put_nowait(data)
+            return True
+        except queue.Full:
+            logger.warning(f"[webhook] Очередь рабочего процесса переполнена, апдейт {data.get('update_id')} отклонён")
+            return False
+
+    def start_worker(self, index: int) -> None:
+        proc = mp.Process(target=_worker_main, args=(index, self.workers, self.queues[index]),
+                          name=f"bot-worker-{index}")
+        proc.start()
+        self.processes[index] = proc
+
+    def watch_workers(self, stop: threading.Event) -> None:
+        # упавший рабочий процесс перезапускается; его очередь при этом сохраняется
+        while not stop.wait(1.0):
+            for index, proc in enumerate(self.processes):
+                if proc is not None and not proc.is_alive() and not self.draining:
+                    logger.error(f"[webhook] Рабочий процесс {index} завершился с кодом {proc.exitcode}, перезапускаем")
+                    self.start_worker(index)
+
+    def drain(self) -> None:
+        # перестаём принимать апдейты и ждём, пока процессы доработают принятые
+        self.draining = True
+        for q in self.queues:
+            q.put(None)
+        deadline = time.monotonic() + WEBHOOK_DRAIN_TIMEOUT_SEC
+        for index, proc in enumerate(self.processes):
+            proc.join(max(0.0, deadline - time.monotonic()))
+            if proc.is_alive():
+                logger.warning(f"[webhook] Рабочий процесс {index} не успел доработать, останавливаем принудительно")
+                proc.terminate()
+                proc.join()
+
+
+def set_webhook() -> None:
+    # регистрирует WEBHOOK_URL в Telegram (если адрес задан в config.json)
+    if not config.WEBHOOK_URL:
+        logger.info("[webhook] WEBHOOK_URL не задан — webhook в Telegram не регистрируем")
+        return
+    payload = {"url": config.WEBHOOK_URL, "max_connections": 100}
+    if config.WEBHOOK_SECRET:
+        payload["secret_token"] = config.WEBHOOK_SECRET
+    req = urllib.request.Request(
+        f"https://api.telegram.org/bot{config.TELEGRAM_BOT_TOKEN}/setWebhook",
+        data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(req, timeout=15) as resp:
+        logger.info(f"[webhook] setWebhook: {resp.read().decode()}")
+
+
+def run_webhook(workers: int = WEBHOOK_WORKERS, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT,
+                register: bool = True) -> None:
+    server = WebhookServer(workers, host, port)
+    for index in range(workers):
+        server.start_worker(index)
+    if register:
+        set_webhook()
+
+    stop = threading.Event()
+    watcher = threading.Thread(target=server.watch_workers, args=(stop,), daemon=True)
+    watcher.start()
+
+    def _on_signal(signum, frame):
+        # новые апдейты с этого момента получают 503 и будут доставлены Telegram повторно;
+        # serve_forever() нельзя останавливать из того же потока — делаем это в отдельном
+        server.draining = True
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+    logger.info(f"[webhook] Слушаем http://{host}:{port}{WEBHOOK_PATH}, рабочих процессов: {workers}")
+    try:
+        server.serve_forever()
+    finally:
+        stop.set()
+        server.server_close()
+        server.drain()
+        logger.info("[webhook] Сервер остановлен")